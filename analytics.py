@@ -0,0 +1,139 @@
+import numpy as np
+
+from app import db, Order, OrderItem, Product, PromoCode
+
+BATCH_SIZE = 50000
+UNIX_EPOCH_JULIAN_DAY = 2440587.5
+DAY_BITS = 32
+
+
+# Rows are pulled in columnar batches and reduced with bincount/unique, so the
+# Python-level work is per batch and per group, never per order line.
+def column_batches(statement, batch_size=BATCH_SIZE):
+    result = db.session.execute(statement.execution_options(stream_results=True, yield_per=batch_size))
+    for partition in result.partitions():
+        yield np.array(partition, dtype=np.float64).T
+
+
+def epoch_day(column):
+    return db.cast(db.func.julianday(column) - UNIX_EPOCH_JULIAN_DAY, db.Integer)
+
+
+def in_period(statement, since, until):
+    if since:
+        statement = statement.where(Order.date >= since)
+    if until:
+        statement = statement.where(Order.date < until)
+    return statement
+
+
+def add_bincount(totals, ids, weights=None):
+    counts = np.bincount(ids, weights=weights)
+    if len(counts) > len(totals):
+        totals = np.pad(totals, (0, len(counts) - len(totals)))
+    totals[:len(counts)] += counts
+    return totals
+
+
+def revenue_by_product_day(since=None, until=None):
+    statement = in_period(
+        db.select(OrderItem.product_id, epoch_day(Order.date), OrderItem.quantity, OrderItem.price)
+        .join(Order, Order.id == OrderItem.order_id), since, until)
+    keys, units, revenue = [], [], []
+    for product_ids, days, quantities, prices in column_batches(statement):
+        batch_keys, inverse = np.unique((product_ids.astype(np.int64) << DAY_BITS) | days.astype(np.int64),
+                                        return_inverse=True)
+        keys.append(batch_keys)
+        units.append(np.bincount(inverse, weights=quantities))
+        revenue.append(np.bincount(inverse, weights=quantities * prices))
+    if not keys:
+        return np.empty(0, np.int64), np.empty(0, 'datetime64[D]'), np.empty(0), np.empty(0)
+    merged_keys, inverse = np.unique(np.concatenate(keys), return_inverse=True)
+    return (merged_keys >> DAY_BITS,
+            (merged_keys & ((1 << DAY_BITS) - 1)).astype('datetime64[D]'),
+            np.bincount(inverse, weights=np.concatenate(units)),
+            np.bincount(inverse, weights=np.concatenate(revenue)))
+
+
+def promo_uplift(since=None, until=None):
+    # Promo id 0 collects the orders placed without a code and is the baseline.
+    statement = in_period(
+        db.select(db.func.coalesce(Order.promo_code_id, 0), Order.total,
+                  db.func.coalesce(Order.discount_applied, 0), Order.item_count), since, until)
+    orders, net, discount, items = np.zeros(0), np.zeros(0), np.zeros(0), np.zeros(0)
+    for promo_ids, totals, discounts, item_counts in column_batches(statement):
+        promo_ids = promo_ids.astype(np.int64)
+        orders = add_bincount(orders, promo_ids)
+        net = add_bincount(net, promo_ids, totals)
+        discount = add_bincount(discount, promo_ids, discounts)
+        items = add_bincount(items, promo_ids, item_counts)
+    used = np.flatnonzero(orders)
+    gross = net + discount
+    with np.errstate(divide='ignore', invalid='ignore'):
+        gross_per_order = gross / orders
+        baseline = gross_per_order[0] if len(orders) and orders[0] else np.nan
+        uplift = gross_per_order / baseline - 1
+    return used, orders[used], gross[used], discount[used], net[used], items[used] / orders[used], uplift[used]
+
+
+def sell_through(since=None, until=None):
+    sold = np.zeros(0)
+    statement = in_period(
+        db.select(OrderItem.product_id, OrderItem.quantity).join(Order, Order.id == OrderItem.order_id),
+        since, until)
+    for product_ids, quantities in column_batches(statement):
+        sold = add_bincount(sold, product_ids.astype(np.int64), quantities)
+    stock = np.zeros(0)
+    for product_ids, stocks in column_batches(db.select(Product.id, Product.stock)):
+        stock = add_bincount(stock, product_ids.astype(np.int64), stocks)
+    size = max(len(sold), len(stock))
+    sold = np.pad(sold, (0, size - len(sold)))
+    stock = np.pad(stock, (0, size - len(stock)))
+    product_ids = np.flatnonzero(sold + stock)
+    sold, stock = sold[product_ids], stock[product_ids]
+    return product_ids, sold, stock, sold / (sold + stock)
+
+
+def sales_report(since=None, until=None):
+    names = dict(db.session.execute(db.select(Product.id, Product.name_en)).all())
+    codes = dict(db.session.execute(db.select(PromoCode.id, PromoCode.code)).all())
+    product_ids, days, units, revenue = revenue_by_product_day(since, until)
+    order = np.lexsort((product_ids, days))
+    promo_ids, orders, gross, discount, net, items_per_order, uplift = promo_uplift(since, until)
+    through_ids, sold, stock, rate = sell_through(since, until)
+    through_order = np.argsort(-rate, kind='stable')
+    return {
+        'revenue_by_product_day': [
+            {'day': str(days[i]), 'product_id': int(product_ids[i]), 'product': names.get(int(product_ids[i]), ''),
+             'units': int(units[i]), 'revenue': round(float(revenue[i]), 2)}
+            for i in order
+        ],
+        'promo_uplift': [
+            {'promo_code': codes.get(int(promo_ids[i])) if promo_ids[i] else None, 'orders': int(orders[i]),
+             'gross_revenue': round(float(gross[i]), 2), 'discount': round(float(discount[i]), 2),
+             'net_revenue': round(float(net[i]), 2), 'items_per_order': round(float(items_per_order[i]), 2),
+             'order_value_uplift': None if np.isnan(uplift[i]) else round(float(uplift[i]), 4)}
+            for i in range(len(promo_ids))
+        ],
+        'sell_through': [
+            {'product_id': int(through_ids[i]), 'product': names.get(int(through_ids[i]), ''), 'sold': int(sold[i]),
+             'stock': int(stock[i]), 'rate': round(float(rate[i]), 4)}
+            for i in through_order
+        ],
+    }
+
+
+def format_report(report, top):
+    lines = ['Revenue per product and day (top {} by revenue)'.format(top)]
+    for row in sorted(report['revenue_by_product_day'], key=lambda row: -row['revenue'])[:top]:
+        lines.append('  {day}  {product_id:>7}  {product:<30}  {units:>7}  {revenue:>12.2f}'.format(**row))
+    lines.append('Promo codes (uplift of gross order value against orders without a code)')
+    for row in report['promo_uplift']:
+        uplift = row['order_value_uplift']
+        lines.append('  {:<15}  {:>7} orders  {:>12.2f} net  {:>10.2f} discount  {:>6} items/order  {}'.format(
+            row['promo_code'] or '(none)', row['orders'], row['net_revenue'], row['discount'],
+            row['items_per_order'], '{:+.1%}'.format(uplift) if uplift is not None else '-'))
+    lines.append('Sell-through (top {})'.format(top))
+    for row in report['sell_through'][:top]:
+        lines.append('  {product_id:>7}  {product:<30}  {sold:>7} sold  {stock:>7} left  {rate:>7.1%}'.format(**row))
+    return '\n'.join(lines)
@@ -1,18 +1,332 @@
-from flask import Flask, render_template, request, redirect, url_for, flash, session
+from flask import Flask, render_template, request, redirect, url_for, flash, session, g, has_app_context, make_response, Response
+from flask import before_render_template, template_rendered, jsonify, abort, send_from_directory
+from flask import stream_with_context
+from flask.json.tag import TaggedJSONSerializer
+from flask.sessions import SessionInterface, SessionMixin
 from flask_sqlalchemy import SQLAlchemy
-from werkzeug.security import generate_password_hash, check_password_hash
-from datetime import datetime, timezone
+from sqlalchemy import event
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.engine import Engine
+from werkzeug.exceptions import ServiceUnavailable, TooManyRequests
+from werkzeug.middleware.proxy_fix import ProxyFix
+from werkzeug.security import safe_join
+from jinja2 import FileSystemBytecodeCache
+from markupsafe import Markup
+from werkzeug.datastructures import CallbackDict
+from collections import OrderedDict, namedtuple
+from concurrent.futures import ProcessPoolExecutor, TimeoutError
+from concurrent.futures.process import BrokenProcessPool
+import click
+from datetime import datetime, timedelta, timezone
+from functools import wraps
+import base64
+import cProfile
+import csv
+import hashlib
+import heapq
+import hmac
+import io
+import json
+import math
+import mimetypes
+import multiprocessing
 import os
+import passwords
 import random
+import re
+import secrets
+import sqlite3
+import subprocess
 import threading
 import time
 
-app = Flask(__name__)
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+# INSTANCE_PATH moves every runtime file (databases, locks, caches, metrics) elsewhere.
+app = Flask(__name__, instance_path=os.path.abspath(os.environ['INSTANCE_PATH'])
+            if os.environ.get('INSTANCE_PATH') else None)
 app.config['SECRET_KEY'] = 'your-secret-key'
-app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///clothing_store.db'
+app.config['SQLALCHEMY_DATABASE_URI'] = os.environ.get('DATABASE_URL', 'sqlite:///clothing_store.db')
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+# Pooled connections are shared by the request threads and the restock scheduler.
+app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {
+    'pool_size': 10,
+    'max_overflow': 20,
+    'pool_timeout': 30,
+    'connect_args': {'timeout': 30, 'check_same_thread': False}
+}
+# WAL lets readers run alongside place_order() and the restock writer; every pooled
+# connection gets the same pragmas when it is opened.
+SQLITE_PROFILES = {
+    'production': {
+        'journal_mode': 'WAL',
+        'busy_timeout': 5000,
+        'synchronous': 'NORMAL',
+        'mmap_size': 256 * 1024 * 1024,
+        'cache_size': -64 * 1024,
+        'temp_store': 'MEMORY'
+    },
+    'default': {}
+}
+app.config['SQLITE_PRAGMAS'] = SQLITE_PROFILES[os.environ.get('DB_PROFILE', 'production')]
+app.config['QUERY_BUDGET_ASSERT'] = os.environ.get('QUERY_BUDGET_ASSERT') == '1'
+app.config['CART_HOLD_TTL'] = 15 * 60
+app.config['CARD_CACHE_SIZE'] = 4096
+app.config['METRICS_FLUSH_INTERVAL'] = 5
+app.config['ADMIN_TOKEN'] = os.environ.get('ADMIN_TOKEN')
+app.config['PROFILE_SAMPLE_RATE'] = float(os.environ.get('PROFILE_SAMPLE_RATE', '0'))
+app.config['SLOW_REQUEST_LOG_SIZE'] = 20
+# Full method strings as werkzeug writes them ('scrypt:32768:8:1', 'pbkdf2:sha256:600000'):
+# stored hashes with another prefix are replaced on the next successful login.
+app.config['PASSWORD_HASH_METHOD'] = os.environ.get('PASSWORD_HASH_METHOD', 'scrypt:32768:8:1')
+app.config['PASSWORD_HASH_WORKERS'] = int(os.environ.get('PASSWORD_HASH_WORKERS', '2'))
+app.config['PASSWORD_HASH_QUEUE_DEPTH'] = 8
+app.config['PASSWORD_HASH_TIMEOUT'] = 10
+app.config['IMAGE_BUILD_DIR'] = os.path.join(app.static_folder, 'build', 'images')
+app.config['ASSET_BUILD_DIR'] = os.path.join(app.static_folder, 'build', 'assets')
+app.config['TAILWINDCSS_BIN'] = os.environ.get('TAILWINDCSS_BIN', 'tailwindcss')
+app.config['IMMUTABLE_MAX_AGE'] = 365 * 24 * 60 * 60
 db = SQLAlchemy(app)
 app.config['DEBUG'] = True
+# Templates are static files: they are parsed once per worker and the compiled code is
+# shared through the bytecode cache, so later starts skip parsing entirely.
+app.config['TEMPLATES_AUTO_RELOAD'] = os.environ.get('TEMPLATES_AUTO_RELOAD') == '1'
+os.makedirs(os.path.join(app.instance_path, 'jinja_cache'), exist_ok=True)
+app.jinja_env.bytecode_cache = FileSystemBytecodeCache(os.path.join(app.instance_path, 'jinja_cache'))
+# 'sqlite' keeps sessions server-side behind an opaque cookie; 'cookie' is Flask's signed cookie.
+app.config['SESSION_BACKEND'] = os.environ.get('SESSION_BACKEND', 'sqlite')
+app.config['SESSION_DATABASE'] = os.path.join(app.instance_path, 'sessions.db')
+app.config['SESSION_CACHE_SIZE'] = 10000
+app.config['SESSION_GC_BATCH_SIZE'] = 1000
+app.config['RATE_LIMIT_ENABLED'] = os.environ.get('RATE_LIMITS', 'on') != 'off'
+# Number of reverse proxies in front of the app whose X-Forwarded-For/-Proto are trusted.
+# Behind a proxy it must be set, or every client shares the proxy's address and its
+# per-IP rate limit bucket; without one it must stay 0, or clients can pick their IP.
+app.config['TRUSTED_PROXIES'] = int(os.environ.get('TRUSTED_PROXIES', '0'))
+app.config['RATE_LIMIT_DATABASE'] = os.path.join(app.instance_path, 'ratelimit.db')
+# Token buckets per route: (burst, seconds to refill the whole burst) per client IP
+# and per user (the logged-in user, or the username being logged in as).
+app.config['RATE_LIMITS'] = {
+    'login': {'ip': (20, 60), 'user': (5, 60)},
+    'apply_promo': {'ip': (30, 60), 'user': (10, 60)},
+    'add_to_cart': {'ip': (120, 60), 'user': (60, 60)},
+    'cart_update': {'ip': (120, 60), 'user': (60, 60)},
+}
+if app.config['TRUSTED_PROXIES']:
+    app.wsgi_app = ProxyFix(app.wsgi_app, x_for=app.config['TRUSTED_PROXIES'],
+                            x_proto=app.config['TRUSTED_PROXIES'])
+
+class SQLiteFileStore:
+    # A small SQLite file shared by every worker, with one autocommit connection per
+    # thread. It never goes through SQLAlchemy, so it doesn't count against the
+    # routes' query budgets.
+    schema = []
+
+    def __init__(self, path):
+        self.path = path
+        self.local = threading.local()
+        for statement in self.schema:
+            self.connection().execute(statement)
+
+    def connection(self):
+        connection = getattr(self.local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            connection.execute('PRAGMA journal_mode = WAL')
+            connection.execute('PRAGMA synchronous = NORMAL')
+            self.local.connection = connection
+        return connection
+
+class SQLiteSessionStore(SQLiteFileStore):
+    schema = [
+        'CREATE TABLE IF NOT EXISTS session ('
+        'id TEXT PRIMARY KEY, data TEXT NOT NULL, revision INTEGER NOT NULL, expires_at REAL NOT NULL)',
+        'CREATE INDEX IF NOT EXISTS ix_session_expires_at ON session (expires_at)',
+    ]
+
+    def load(self, sid, now):
+        return self.connection().execute(
+            'SELECT data, revision, expires_at FROM session WHERE id = ? AND expires_at > ?', (sid, now)).fetchone()
+
+    def insert(self, sid, data, revision, expires_at):
+        self.connection().execute(
+            'INSERT INTO session (id, data, revision, expires_at) VALUES (?, ?, ?, ?)',
+            (sid, data, revision, expires_at))
+
+    def update(self, sid, data, revision, expires_at, expected_revision):
+        # Compare-and-swap: False when another request saved the session (or it was
+        # deleted) since expected_revision was read.
+        return self.connection().execute(
+            'UPDATE session SET data = ?, revision = ?, expires_at = ? WHERE id = ? AND revision = ?',
+            (data, revision, expires_at, sid, expected_revision)).rowcount == 1
+
+    def delete(self, sid):
+        self.connection().execute('DELETE FROM session WHERE id = ?', (sid,))
+
+    def delete_expired(self, now, batch_size):
+        # Short batches keep the write lock brief for the workers saving sessions.
+        removed = 0
+        while True:
+            count = self.connection().execute(
+                'DELETE FROM session WHERE id IN (SELECT id FROM session WHERE expires_at <= ? LIMIT ?)',
+                (now, batch_size)).rowcount
+            removed += count
+            if count < batch_size:
+                return removed
+
+class ServerSession(CallbackDict, SessionMixin):
+    def __init__(self, initial=None, sid=None, revision=0, expires_at=0, data=None, cookie_revision=0):
+        def on_update(self):
+            self.modified = True
+        super().__init__(initial, on_update)
+        self.loaded_user_id = self.get('user_id')
+        self.sid = sid
+        self.revision = revision
+        self.expires_at = expires_at
+        # The serialized form it was loaded from, to work out this request's changes on a conflict.
+        self.data = data
+        self.cookie_revision = cookie_revision
+        self.modified = False
+
+class ServerSessionInterface(SessionInterface):
+    # The cookie holds "<sid>.<revision>". Each worker keeps an LRU of serialized
+    # sessions; an entry is used only while its revision matches the cookie, so a
+    # session saved by another worker is read again from the store. Saves are
+    # compare-and-swap on the revision, so one revision always means one content;
+    # a request that lost the race merges its changes into the stored session.
+    serializer = TaggedJSONSerializer()
+    save_attempts = 5
+
+    def __init__(self, store, cache_size):
+        self.store = store
+        self.cache_size = cache_size
+        self.cache = OrderedDict()
+        self.lock = threading.Lock()
+
+    def cached(self, sid, revision, now):
+        with self.lock:
+            entry = self.cache.get(sid)
+            if entry is None or entry[1] != revision or entry[2] <= now:
+                return None
+            self.cache.move_to_end(sid)
+            return entry
+
+    def remember(self, sid, data, revision, expires_at):
+        with self.lock:
+            self.cache[sid] = (data, revision, expires_at)
+            self.cache.move_to_end(sid)
+            while len(self.cache) > self.cache_size:
+                self.cache.popitem(last=False)
+
+    def forget(self, sid):
+        with self.lock:
+            self.cache.pop(sid, None)
+
+    def open_session(self, app, request):
+        sid, _, revision = request.cookies.get(self.get_cookie_name(app), '').partition('.')
+        if not sid or not revision.isdigit():
+            return ServerSession()
+        now = time.time()
+        entry = self.cached(sid, int(revision), now)
+        if entry is None:
+            entry = self.store.load(sid, now)
+            if entry is None:
+                return ServerSession()
+            self.remember(sid, *entry)
+        data, stored_revision, expires_at = entry
+        return ServerSession(self.serializer.loads(data), sid, stored_revision, expires_at, data, int(revision))
+
+    def merge(self, session, stored):
+        # Keys this request set win; keys it removed are dropped unless someone else
+        # changed them in the meantime.
+        original = self.serializer.loads(session.data)
+        merged = self.serializer.loads(stored)
+        for key, value in session.items():
+            if key not in original or original[key] != value:
+                merged[key] = value
+        for key in original.keys() - session.keys():
+            if key in merged and merged[key] == original[key]:
+                del merged[key]
+        return merged
+
+    def save_session(self, app, session, response):
+        name = self.get_cookie_name(app)
+        domain = self.get_cookie_domain(app)
+        path = self.get_cookie_path(app)
+        if not session:
+            if session.sid is not None:
+                self.store.delete(session.sid)
+                self.forget(session.sid)
+                response.delete_cookie(name, domain=domain, path=path, secure=self.get_cookie_secure(app),
+                                       samesite=self.get_cookie_samesite(app), httponly=self.get_cookie_httponly(app))
+            return
+        if session.accessed:
+            response.vary.add('Cookie')
+        # Unchanged sessions are only written again once half of their lifetime is used up.
+        now = time.time()
+        lifetime = app.permanent_session_lifetime.total_seconds()
+        if not session.modified and session.expires_at - now > lifetime / 2:
+            if session.revision != session.cookie_revision:
+                # The cookie is behind the store (a concurrent response set it last), so
+                # it is moved forward and every worker serves the same revision again.
+                self.set_cookie(app, response, session, session.sid, session.revision)
+            return
+        sid = session.sid
+        if sid is None or session.get('user_id') != session.loaded_user_id:
+            # A new ID on login and logout, so a planted cookie never becomes authenticated.
+            if sid is not None:
+                self.store.delete(sid)
+                self.forget(sid)
+            sid = secrets.token_urlsafe(32)
+        expires_at = now + lifetime
+        data = self.serializer.dumps(dict(session))
+        if sid != session.sid:
+            revision = 1
+            self.store.insert(sid, data, revision, expires_at)
+        else:
+            expected = session.revision
+            for _ in range(self.save_attempts):
+                revision = expected + 1
+                if self.store.update(sid, data, revision, expires_at, expected):
+                    break
+                stored = self.store.load(sid, now)
+                if stored is None:
+                    # Deleted or rotated by a concurrent logout/login: nothing to save into.
+                    self.forget(sid)
+                    return
+                if not session.modified:
+                    # Only the expiry was being refreshed, and the concurrent save did that.
+                    data, revision, expires_at = stored
+                    break
+                data = self.serializer.dumps(self.merge(session, stored[0]))
+                expected = stored[1]
+            else:
+                app.logger.warning('Session %s kept changing, dropped this request\'s changes', sid[:8])
+                return
+        self.remember(sid, data, revision, expires_at)
+        self.set_cookie(app, response, session, sid, revision)
+
+    def set_cookie(self, app, response, session, sid, revision):
+        response.set_cookie(self.get_cookie_name(app), '{}.{}'.format(sid, revision),
+                            expires=self.get_expiration_time(app, session), httponly=self.get_cookie_httponly(app),
+                            domain=self.get_cookie_domain(app), path=self.get_cookie_path(app),
+                            secure=self.get_cookie_secure(app), samesite=self.get_cookie_samesite(app))
+
+if app.config['SESSION_BACKEND'] == 'sqlite':
+    app.session_interface = ServerSessionInterface(SQLiteSessionStore(app.config['SESSION_DATABASE']),
+                                                   app.config['SESSION_CACHE_SIZE'])
+
+@event.listens_for(Engine, 'connect')
+def apply_sqlite_pragmas(dbapi_connection, connection_record):
+    if not isinstance(dbapi_connection, sqlite3.Connection):
+        return
+    cursor = dbapi_connection.cursor()
+    for name, value in app.config['SQLITE_PRAGMAS'].items():
+        cursor.execute('PRAGMA {} = {}'.format(name, value))
+    cursor.close()
 
 translations = {
     'en': {
@@ -29,6 +343,8 @@ translations = {
         'add_to_cart': 'Add to Cart',
         'your_cart': 'Your Cart',
         'remove': 'Remove',
+        'update_cart': 'Update cart',
+        'cart_updated': 'Cart updated',
         'total': 'Total',
         'place_order': 'Place Order',
         'your_orders': 'Your Orders',
@@ -46,9 +362,26 @@ translations = {
         'apply_promo': 'Apply',
         'invalid_promo': 'Invalid or expired promo code',
         'promo_applied': 'Promo code applied! Discount: {}%',
+        'promo_limit_reached': 'This promo code has reached its usage limit',
         'delivery_address': 'Delivery Address',
         'address_required': 'Delivery address is required',
-        'discount': 'Discount'
+        'discount': 'Discount',
+        'filter': 'Filter',
+        'min_price': 'Min price',
+        'max_price': 'Max price',
+        'in_stock_only': 'In stock only',
+        'sort': 'Sort',
+        'sort_default': 'Default',
+        'sort_price_asc': 'Price: low to high',
+        'sort_price_desc': 'Price: high to low',
+        'sort_name': 'Name',
+        'next_page': 'Next page',
+        'first_page': 'First page',
+        'no_products': 'No products found.',
+        'bought_together': 'Frequently bought together',
+        'search': 'Search',
+        'search_results': 'Search results for "{}"',
+        'items_count': 'Items: {}'
     },
     'ru': {
         'title': 'Магазин одежды',
@@ -64,6 +397,8 @@ translations = {
         'add_to_cart': 'Добавить в корзину',
         'your_cart': 'Ваша корзина',
         'remove': 'Удалить',
+        'update_cart': 'Обновить корзину',
+        'cart_updated': 'Корзина обновлена',
         'total': 'Итого',
         'place_order': 'Оформить заказ',
         'your_orders': 'Ваши заказы',
@@ -81,9 +416,26 @@ translations = {
         'apply_promo': 'Применить',
         'invalid_promo': 'Недействительный или истекший промокод',
         'promo_applied': 'Промокод применен! Скидка: {}%',
+        'promo_limit_reached': 'Лимит использования этого промокода исчерпан',
         'delivery_address': 'Адрес доставки',
         'address_required': 'Требуется адрес доставки',
-        'discount': 'Скидка'
+        'discount': 'Скидка',
+        'filter': 'Фильтр',
+        'min_price': 'Цена от',
+        'max_price': 'Цена до',
+        'in_stock_only': 'Только в наличии',
+        'sort': 'Сортировка',
+        'sort_default': 'По умолчанию',
+        'sort_price_asc': 'Цена: по возрастанию',
+        'sort_price_desc': 'Цена: по убыванию',
+        'sort_name': 'По названию',
+        'next_page': 'Следующая страница',
+        'first_page': 'В начало',
+        'no_products': 'Товары не найдены.',
+        'bought_together': 'Часто покупают вместе',
+        'search': 'Поиск',
+        'search_results': 'Результаты поиска: «{}»',
+        'items_count': 'Товаров: {}'
     }
 }
 
@@ -95,14 +447,24 @@ class User(db.Model):
 
 class Product(db.Model):
     id = db.Column(db.Integer, primary_key=True)
-    name_en = db.Column(db.String(120), nullable=False)
-    name_ru = db.Column(db.String(120), nullable=False)
-    price = db.Column(db.Float, nullable=False)
+    name_en = db.Column(db.String(120), nullable=False, index=True)
+    name_ru = db.Column(db.String(120), nullable=False, index=True)
+    price = db.Column(db.Float, nullable=False, index=True)
     description_en = db.Column(db.Text, nullable=True)
     description_ru = db.Column(db.Text, nullable=True)
     image = db.Column(db.String(120), nullable=True)
-    stock = db.Column(db.Integer, nullable=False, default=0)
-    restock_time = db.Column(db.DateTime(timezone=True), nullable=True)
+    sku = db.Column(db.String(64), nullable=True, unique=True, index=True)
+    stock = db.Column(db.Integer, nullable=False, default=0, index=True)
+    reserved = db.Column(db.Integer, nullable=False, default=0)
+    restock_time = db.Column(db.DateTime(timezone=True), nullable=True, index=True)
+    # Bumped by every ORM and Core UPDATE of the row; drives card caching and HTTP validators.
+    revision = db.Column(db.Integer, nullable=False, default=1, onupdate=db.text('revision + 1'))
+    updated_at = db.Column(db.DateTime(timezone=True), nullable=True, default=lambda: datetime.now(timezone.utc),
+                           onupdate=lambda: datetime.now(timezone.utc))
+
+    @property
+    def available(self):
+        return self.stock - (self.reserved or 0)
 
 class CartItem(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -111,6 +473,18 @@ class CartItem(db.Model):
     quantity = db.Column(db.Integer, nullable=False, default=1)
     user = db.relationship('User', backref='cart_items')
     product = db.relationship('Product', backref='cart_items')
+    __table_args__ = (db.Index('ix_cart_item_user_product', 'user_id', 'product_id', unique=True),)
+
+class StockHold(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    product_id = db.Column(db.Integer, db.ForeignKey('product.id'), nullable=False)
+    quantity = db.Column(db.Integer, nullable=False)
+    expires_at = db.Column(db.DateTime(timezone=True), nullable=False, index=True)
+    __table_args__ = (
+        db.UniqueConstraint('user_id', 'product_id'),
+        db.Index('ix_stock_hold_product_expires', 'product_id', 'expires_at'),
+    )
 
 class PromoCode(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -118,6 +492,17 @@ class PromoCode(db.Model):
     discount_percent = db.Column(db.Integer, nullable=False)
     valid_until = db.Column(db.DateTime(timezone=True), nullable=False)
     is_active = db.Column(db.Boolean, default=True)
+    # NULL limits mean unlimited; uses is only ever changed by a conditional UPDATE.
+    max_uses = db.Column(db.Integer, nullable=True)
+    per_user_limit = db.Column(db.Integer, nullable=True)
+    uses = db.Column(db.Integer, nullable=False, default=0)
+
+class PromoRedemption(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    promo_code_id = db.Column(db.Integer, db.ForeignKey('promo_code.id'), nullable=False)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    uses = db.Column(db.Integer, nullable=False, default=0)
+    __table_args__ = (db.UniqueConstraint('promo_code_id', 'user_id'),)
 
 class Order(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -129,140 +514,1334 @@ class Order(db.Model):
     longitude = db.Column(db.Float, nullable=True)
     promo_code_id = db.Column(db.Integer, db.ForeignKey('promo_code.id'), nullable=True)
     discount_applied = db.Column(db.Float, nullable=True)
+    # Written once at checkout so the order history never walks OrderItem/Product.
+    item_count = db.Column(db.Integer, nullable=False, default=0)
+    summary_en = db.Column(db.Text, nullable=True)
+    summary_ru = db.Column(db.Text, nullable=True)
     user = db.relationship('User', backref='orders')
     promo_code = db.relationship('PromoCode')
+    __table_args__ = (db.Index('ix_order_user_date', 'user_id', 'date'),)
 
 class OrderItem(db.Model):
     id = db.Column(db.Integer, primary_key=True)
-    order_id = db.Column(db.Integer, db.ForeignKey('order.id'), nullable=False)
+    order_id = db.Column(db.Integer, db.ForeignKey('order.id'), nullable=False, index=True)
     product_id = db.Column(db.Integer, db.ForeignKey('product.id'), nullable=False)
     quantity = db.Column(db.Integer, nullable=False)
     price = db.Column(db.Float, nullable=False)
     order = db.relationship('Order', backref='items')
     product = db.relationship('Product')
 
+# Co-purchase counts, stored once per direction so a product's pairs are an index range.
+class ProductPair(db.Model):
+    product_id = db.Column(db.Integer, db.ForeignKey('product.id'), primary_key=True)
+    other_id = db.Column(db.Integer, db.ForeignKey('product.id'), primary_key=True)
+    orders = db.Column(db.Integer, nullable=False, default=0)
+    __table_args__ = (db.Index('ix_product_pair_product_orders', 'product_id', 'orders', 'other_id'),)
+
+# The top RECOMMENDATION_COUNT pairs of each product, refreshed when its counts change.
+class ProductNeighbor(db.Model):
+    product_id = db.Column(db.Integer, db.ForeignKey('product.id'), primary_key=True)
+    neighbor_id = db.Column(db.Integer, db.ForeignKey('product.id'), primary_key=True)
+    score = db.Column(db.Integer, nullable=False)
+
+# External-content FTS5 index over the product texts. unicode61 folds case for both
+# Cyrillic and Latin, remove_diacritics also maps "ё" to "е", and the prefix indexes
+# keep "term*" queries from scanning the whole vocabulary.
+SEARCH_INDEX_SQL = [
+    "CREATE VIRTUAL TABLE IF NOT EXISTS product_fts USING fts5("
+    "name_en, name_ru, description_en, description_ru, content='product', content_rowid='id', "
+    "tokenize='unicode61 remove_diacritics 2', prefix='2 3')",
+    "CREATE TRIGGER IF NOT EXISTS product_fts_insert AFTER INSERT ON product BEGIN "
+    "INSERT INTO product_fts(rowid, name_en, name_ru, description_en, description_ru) "
+    "VALUES (new.id, new.name_en, new.name_ru, new.description_en, new.description_ru); END",
+    "CREATE TRIGGER IF NOT EXISTS product_fts_delete AFTER DELETE ON product BEGIN "
+    "INSERT INTO product_fts(product_fts, rowid, name_en, name_ru, description_en, description_ru) "
+    "VALUES ('delete', old.id, old.name_en, old.name_ru, old.description_en, old.description_ru); END",
+    "CREATE TRIGGER IF NOT EXISTS product_fts_update "
+    "AFTER UPDATE OF name_en, name_ru, description_en, description_ru ON product BEGIN "
+    "INSERT INTO product_fts(product_fts, rowid, name_en, name_ru, description_en, description_ru) "
+    "VALUES ('delete', old.id, old.name_en, old.name_ru, old.description_en, old.description_ru); "
+    "INSERT INTO product_fts(rowid, name_en, name_ru, description_en, description_ru) "
+    "VALUES (new.id, new.name_en, new.name_ru, new.description_en, new.description_ru); END",
+]
+SEARCH_RESULT_LIMIT = 48
+
+def create_search_index():
+    for statement in SEARCH_INDEX_SQL:
+        db.session.execute(db.text(statement))
+    db.session.execute(db.text("INSERT INTO product_fts(product_fts) VALUES ('rebuild')"))
+    db.session.commit()
+
+def search_match_expression(query):
+    terms = re.findall(r'\w+', query.lower())[:8]
+    return ' '.join('"{}"*'.format(term) for term in terms)
+
+def search_products(query, lang, limit=SEARCH_RESULT_LIMIT):
+    match = search_match_expression(query)
+    if not match:
+        return []
+    # bm25 column weights: the name in the visitor's language ranks highest.
+    weights = '10.0, 5.0, 2.0, 1.0' if lang == 'en' else '5.0, 10.0, 1.0, 2.0'
+    statement = db.select(Product).from_statement(db.text(
+        "SELECT product.* FROM product_fts JOIN product ON product.id = product_fts.rowid "
+        "WHERE product_fts MATCH :match "
+        "ORDER BY bm25(product_fts, {}) LIMIT :limit".format(weights)))
+    return db.session.execute(statement, {'match': match, 'limit': limit}).scalars().all()
+
+RESTOCK_DELAY = 100
+RESTOCK_MAX_SLEEP = 60
+restock_wakeup = threading.Event()
+
+def as_utc(value):
+    if value is not None and value.tzinfo is None:
+        return value.replace(tzinfo=timezone.utc)
+    return value
+
+def acquire_file_lock(name, blocking=False):
+    os.makedirs(app.instance_path, exist_ok=True)
+    handle = open(os.path.join(app.instance_path, name), 'a')
+    if fcntl is None:
+        return handle
+    try:
+        fcntl.flock(handle, fcntl.LOCK_EX | (0 if blocking else fcntl.LOCK_NB))
+    except OSError:
+        handle.close()
+        return None
+    return handle
+
+def next_restock_due():
+    # restock_time is set when a product sells out but can outlive that (an import or a
+    # manual edit restocking it), so only sold-out rows count; they are read through
+    # the stock index.
+    restock_time = db.session.query(db.func.min(Product.restock_time)).filter(Product.stock == 0).scalar()
+    if restock_time is None:
+        return None
+    return as_utc(restock_time) + timedelta(seconds=RESTOCK_DELAY)
+
+def restock_due_products(now):
+    product_ids = [product_id for product_id, in db.session.query(Product.id).filter(
+        Product.restock_time <= now - timedelta(seconds=RESTOCK_DELAY), Product.stock == 0)]
+    if not product_ids:
+        return 0
+    result = db.session.execute(
+        db.update(Product)
+        .where(Product.id.in_(product_ids), Product.stock == 0)
+        .values(stock=10 + db.func.abs(db.func.random()) % 11, restock_time=None)
+        .execution_options(synchronize_session=False))
+    db.session.commit()
+    invalidate_product_cards(product_ids)
+    return result.rowcount
+
+def held_quantity(user_id):
+    return (db.select(db.func.coalesce(db.func.sum(StockHold.quantity), 0))
+            .where(StockHold.user_id == user_id, StockHold.product_id == Product.id)
+            .scalar_subquery())
+
+def hold_stock(user_id, product_id, quantity, now):
+    # Product.reserved is the sum of all holds on the product, so availability is
+    # checked and claimed in one conditional UPDATE.
+    result = db.session.execute(
+        db.update(Product)
+        .where(Product.id == product_id, Product.stock - Product.reserved >= quantity)
+        .values(reserved=Product.reserved + quantity)
+        .execution_options(synchronize_session=False))
+    if result.rowcount == 0:
+        return False
+    expires_at = now + timedelta(seconds=app.config['CART_HOLD_TTL'])
+    db.session.execute(
+        sqlite_insert(StockHold)
+        .values(user_id=user_id, product_id=product_id, quantity=quantity, expires_at=expires_at)
+        .on_conflict_do_update(index_elements=['user_id', 'product_id'],
+                               set_={'quantity': StockHold.quantity + quantity, 'expires_at': expires_at}))
+    return True
+
+def release_holds(user_id, product_ids):
+    db.session.execute(
+        db.update(Product)
+        .where(Product.id.in_(product_ids))
+        .values(reserved=Product.reserved - held_quantity(user_id))
+        .execution_options(synchronize_session=False))
+    db.session.execute(
+        db.delete(StockHold)
+        .where(StockHold.user_id == user_id, StockHold.product_id.in_(product_ids))
+        .execution_options(synchronize_session=False))
+
+def decrement_stock(user_id, lines, now):
+    # The user's own holds count towards what they may buy and are consumed with the stock.
+    failed = []
+    for product_id, quantity in lines:
+        held = held_quantity(user_id)
+        result = db.session.execute(
+            db.update(Product)
+            .where(Product.id == product_id, Product.stock - Product.reserved + held >= quantity)
+            .values(stock=Product.stock - quantity,
+                    reserved=Product.reserved - held,
+                    restock_time=db.case((Product.stock == quantity, now), else_=Product.restock_time))
+            .execution_options(synchronize_session=False))
+        if result.rowcount == 0:
+            failed.append(product_id)
+    if not failed:
+        db.session.execute(
+            db.delete(StockHold)
+            .where(StockHold.user_id == user_id, StockHold.product_id.in_([line[0] for line in lines]))
+            .execution_options(synchronize_session=False))
+    return failed
+
+def record_co_purchases(product_ids):
+    # Only the products in the order gain counts, so only their top-K lists can change;
+    # each refresh reads RECOMMENDATION_COUNT rows off the end of the pair index.
+    product_ids = sorted(set(product_ids))
+    if len(product_ids) < 2:
+        return
+    statement = sqlite_insert(ProductPair)
+    db.session.execute(
+        statement.on_conflict_do_update(index_elements=['product_id', 'other_id'],
+                                        set_={'orders': ProductPair.orders + 1}),
+        [{'product_id': product_id, 'other_id': other_id, 'orders': 1}
+         for product_id in product_ids for other_id in product_ids if other_id != product_id])
+    neighbors = []
+    for product_id in product_ids:
+        neighbors.extend({'product_id': product_id, 'neighbor_id': other_id, 'score': orders}
+                         for other_id, orders in db.session.execute(
+                             db.select(ProductPair.other_id, ProductPair.orders)
+                             .where(ProductPair.product_id == product_id)
+                             .order_by(ProductPair.orders.desc(), ProductPair.other_id.desc())
+                             .limit(RECOMMENDATION_COUNT)))
+    db.session.execute(
+        db.delete(ProductNeighbor)
+        .where(ProductNeighbor.product_id.in_(product_ids))
+        .execution_options(synchronize_session=False))
+    db.session.execute(db.insert(ProductNeighbor), neighbors)
+
+def next_hold_expiry():
+    return as_utc(db.session.query(db.func.min(StockHold.expires_at)).scalar())
+
+def expire_holds(now):
+    # Expired holds are found through the expires_at index and released in bulk.
+    expired = (db.select(db.func.sum(StockHold.quantity))
+               .where(StockHold.product_id == Product.id, StockHold.expires_at <= now)
+               .scalar_subquery())
+    db.session.execute(
+        db.update(Product)
+        .where(Product.id.in_(db.select(StockHold.product_id).where(StockHold.expires_at <= now)))
+        .values(reserved=Product.reserved - expired)
+        .execution_options(synchronize_session=False))
+    product_ids = [product_id for product_id, in db.session.query(StockHold.product_id).filter(
+        StockHold.expires_at <= now).distinct()]
+    result = db.session.execute(
+        db.delete(StockHold).where(StockHold.expires_at <= now).execution_options(synchronize_session=False))
+    db.session.commit()
+    invalidate_product_cards(product_ids)
+    return result.rowcount
+
 def restock_products():
     while True:
         with app.app_context():
-            products = Product.query.all()
-            current_time = datetime.now(timezone.utc)
-            for product in products:
-                if product.stock == 0 and product.restock_time:
-                    restock_time = product.restock_time
-                    if restock_time.tzinfo is None:
-                        restock_time = restock_time.replace(tzinfo=timezone.utc)
-                    time_elapsed = (current_time - restock_time).total_seconds()
-                    if time_elapsed >= 100:
-                        product.stock = random.randint(10, 20)
-                        product.restock_time = None
-                        db.session.commit()
-        time.sleep(10)
+            started = time.perf_counter()
+            now = datetime.now(timezone.utc)
+            due = expiry = None
+            # A failed cycle (e.g. "database is locked") must not end the leader thread:
+            # it is rolled back, logged and retried after the regular sleep.
+            try:
+                due = next_restock_due()
+                if due is not None and due <= now:
+                    metrics.inc('shop_restocked_products_total', (), restock_due_products(now))
+                    due = next_restock_due()
+                expiry = next_hold_expiry()
+                if expiry is not None and expiry <= now:
+                    metrics.inc('shop_expired_holds_total', (), expire_holds(now))
+                    expiry = next_hold_expiry()
+                if isinstance(app.session_interface, ServerSessionInterface):
+                    metrics.inc('shop_expired_sessions_total', (), app.session_interface.store.delete_expired(
+                        time.time(), app.config['SESSION_GC_BATCH_SIZE']))
+                metrics.inc('shop_idle_rate_limit_buckets_total', (), rate_limits.delete_idle(
+                    time.time(), app.config['SESSION_GC_BATCH_SIZE']))
+            except Exception:
+                db.session.rollback()
+                due = expiry = None
+                metrics.inc('shop_restock_cycle_errors_total')
+                app.logger.exception('Restock cycle failed')
+            metrics.observe('shop_restock_cycle_duration_seconds', (), time.perf_counter() - started)
+            metrics.flush()
+        pending = [moment for moment in (due, expiry) if moment is not None]
+        timeout = RESTOCK_MAX_SLEEP
+        if pending:
+            timeout = min(max((min(pending) - now).total_seconds(), 0), RESTOCK_MAX_SLEEP)
+        # Sold-out products in this worker wake the scheduler early; the sleep cap
+        # picks up products sold out by other workers.
+        restock_wakeup.wait(timeout)
+        restock_wakeup.clear()
 
-with app.app_context():
-    db.drop_all()
-    db.create_all()
-    if not Product.query.first():
-        products = [
-            Product(name_en="Baggy Jeans", name_ru="Свободные джинсы", price=49.99,
-                    description_en="Loose fit denim jeans", description_ru="Джинсы свободного кроя",
-                    image="Baggy_Jeans.jpg", stock=random.randint(10, 20)),
-            Product(name_en="Baggy Pants", name_ru="Свободные штаны", price=44.99,
-                    description_en="Relaxed casual pants", description_ru="Повседневные штаны свободного кроя",
-                    image="Baggy_pants.jpg", stock=random.randint(10, 20)),
-            Product(name_en="Bandana T-shirt", name_ru="Футболка с банданой", price=24.99,
-                    description_en="Stylish bandana print tee", description_ru="Футболка с принтом банданы",
-                    image="Bandana_T-shirt.jpg", stock=random.randint(10, 20)),
-            Product(name_en="Black T-shirt", name_ru="Черная футболка", price=19.99, description_en="Classic black tee",
-                    description_ru="Классическая черная футболка", image="Black_T-shirt.jpg",
-                    stock=random.randint(10, 20)),
-            Product(name_en="BLG T-shirt", name_ru="Футболка BLG", price=21.99,
-                    description_en="Dark green BLG print tee", description_ru="Темно-зеленая футболка с принтом BLG",
-                    image="BLG_T-shirt.jpg", stock=random.randint(10, 20)),
-            Product(name_en="Blue T-shirt", name_ru="Голубая футболка", price=18.99,
-                    description_en="Soft blue cotton tee", description_ru="Мягкая голубая хлопковая футболка",
-                    image="Blue_T-shirt.jpg", stock=random.randint(10, 20)),
-            Product(name_en="Cargo Pants", name_ru="Штаны карго", price=39.99, description_en="Utility cargo pants",
-                    description_ru="Функциональные штаны карго", image="Cargo_pants.jpg", stock=random.randint(10, 20)),
-            Product(name_en="Fashion Boots", name_ru="Модные ботинки", price=59.99,
-                    description_en="Trendy fashion boots", description_ru="Модные ботинки", image="Fashion_boots.jpg",
-                    stock=random.randint(10, 20)),
-            Product(name_en="Fashion Sneakers", name_ru="Модные кроссовки", price=64.99,
-                    description_en="High-top fashion sneakers", description_ru="Модные высокие кроссовки",
-                    image="Fashion_sneakers.jpg", stock=random.randint(10, 20)),
-            Product(name_en="Fashion T-shirt", name_ru="Модная футболка", price=22.99,
-                    description_en="Branded fashion tee", description_ru="Фирменная модная футболка",
-                    image="Fashion_t-shirt.jpg", stock=random.randint(10, 20)),
-            Product(name_en="Fashionable T-shirt", name_ru="Фешенебельная футболка", price=27.99,
-                    description_en="Trendy logo tee", description_ru="Модная футболка с логотипом",
-                    image="Fashionable_T-shirt.jpg", stock=random.randint(10, 20)),
-            Product(name_en="Glitter T-shirt", name_ru="Блестящая футболка", price=23.99,
-                    description_en="T-shirt with glitter print", description_ru="Футболка с блестящим принтом",
-                    image="Glitter_t-shirt.jpg", stock=random.randint(10, 20)),
-            Product(name_en="Gray Sweater", name_ru="Серый свитер", price=34.99, description_en="Comfy gray sweater",
-                    description_ru="Уютный серый свитер", image="Gray_sweater.jpg", stock=random.randint(10, 20)),
-            Product(name_en="Green T-shirt", name_ru="Зеленая футболка", price=19.99,
-                    description_en="Bright green t-shirt", description_ru="Яркая зеленая футболка",
-                    image="Green_T-shirt.jpg", stock=random.randint(10, 20)),
-            Product(name_en="Jeans", name_ru="Джинсы", price=44.99, description_en="Classic straight jeans",
-                    description_ru="Классические прямые джинсы", image="Jeans1.jpg", stock=random.randint(10, 20)),
-            Product(name_en="Jungle T-shirt", name_ru="Футболка Jungle", price=25.99,
-                    description_en="T-shirt with jungle print", description_ru="Футболка с принтом джунглей",
-                    image="jungle_t-shirt.jpg", stock=random.randint(10, 20)),
-            Product(name_en="Polo", name_ru="Поло", price=31.99, description_en="Black polo shirt",
-                    description_ru="Черная рубашка поло", image="polo.jpg", stock=random.randint(10, 20)),
-            Product(name_en="Red Sneakers", name_ru="Красные кроссовки", price=59.99,
-                    description_en="Bright red athletic sneakers", description_ru="Яркие красные кроссовки",
-                    image="Red_sneakers.jpg", stock=random.randint(10, 20)),
-            Product(name_en="Running Sneakers", name_ru="Беговые кроссовки", price=64.99,
-                    description_en="Lightweight running sneakers", description_ru="Легкие кроссовки для бега",
-                    image="Running_sneakers.jpg", stock=random.randint(10, 20)),
-            Product(name_en="Spotted Pants", name_ru="Штаны с пятнами", price=35.99,
-                    description_en="Patterned casual pants", description_ru="Повседневные штаны с пятнами",
-                    image="Spotted_pants.jpg", stock=random.randint(10, 20)),
-            Product(name_en="Sweater", name_ru="Свитер", price=34.99, description_en="Warm pink sweater",
-                    description_ru="Теплый розовый свитер", image="Sweater.jpg", stock=random.randint(10, 20)),
-            Product(name_en="Torn BT-shirt", name_ru="Рваная футболка (BT)", price=24.99,
-                    description_en="Black torn t-shirt", description_ru="Черная рваная футболка",
-                    image="Torn_bt-shirt.jpg", stock=random.randint(10, 20)),
-            Product(name_en="Torn T-shirt", name_ru="Рваная футболка", price=24.99,
-                    description_en="Givenchy style torn tee", description_ru="Футболка в стиле Givenchy",
-                    image="Torn_t-shirt.jpg", stock=random.randint(10, 20)),
-            Product(name_en="Trousers", name_ru="Брюки", price=42.99, description_en="Formal black trousers",
-                    description_ru="Классические черные брюки", image="trousers.jpg", stock=random.randint(10, 20)),
-            Product(name_en="T-shirt", name_ru="Футболка", price=19.99, description_en="Everyday black tee",
-                    description_ru="Повседневная черная футболка", image="T-shirt.jpg", stock=random.randint(10, 20)),
-            Product(name_en="T-shirt with Print", name_ru="Футболка с принтом", price=22.99,
-                    description_en="Yellow tee with print", description_ru="Желтая футболка с принтом",
-                    image="T-shirt_w_print.jpg", stock=random.randint(10, 20)),
-            Product(name_en="Turquoise T-shirt", name_ru="Бирюзовая футболка", price=20.99,
-                    description_en="Two-tone turquoise t-shirt", description_ru="Двухцветная бирюзовая футболка",
-                    image="turquoise_t-shirt.jpg", stock=random.randint(10, 20)),
-            Product(name_en="W T-shirt", name_ru="Футболка W", price=21.99, description_en="W logo print t-shirt",
-                    description_ru="Футболка с принтом W", image="W_T-shirt.jpg", stock=random.randint(10, 20)),
-            Product(name_en="White Boots", name_ru="Белые ботинки", price=54.99, description_en="Stylish white boots",
-                    description_ru="Стильные белые ботинки", image="White_boots.jpg", stock=random.randint(10, 20)),
-        ]
-        db.session.bulk_save_objects(products)
-        promo_codes = [
-            PromoCode(
-                code="EASTER20",
-                discount_percent=20,
-                valid_until=datetime(2025, 12, 31, tzinfo=timezone.utc)
-            ),
-            PromoCode(
-                code="ROMANOVLEXA25",
-                discount_percent=25,
-                valid_until=datetime(2025, 12, 31, tzinfo=timezone.utc)
-            )
-        ]
-        db.session.bulk_save_objects(promo_codes)
+def run_restock_scheduler():
+    # Only the worker holding the lock restocks; the others retry in case it exits.
+    lock = acquire_file_lock('restock.lock')
+    while lock is None:
+        time.sleep(RESTOCK_MAX_SLEEP)
+        lock = acquire_file_lock('restock.lock')
+    restock_products()
+
+RECOMMENDATION_COUNT = 4
+RECOMMENDATION_REBUILD_SQL = [
+    "DELETE FROM product_neighbor",
+    "DELETE FROM product_pair",
+    "INSERT INTO product_pair (product_id, other_id, orders) "
+    "SELECT a.product_id, b.product_id, COUNT(*) FROM order_item a "
+    "JOIN order_item b ON b.order_id = a.order_id AND b.product_id != a.product_id "
+    "GROUP BY a.product_id, b.product_id",
+    "INSERT INTO product_neighbor (product_id, neighbor_id, score) "
+    "SELECT product_id, other_id, orders FROM (SELECT product_id, other_id, orders, row_number() OVER ("
+    "PARTITION BY product_id ORDER BY orders DESC, other_id DESC) AS position FROM product_pair) "
+    "WHERE position <= {:d}".format(RECOMMENDATION_COUNT),
+]
+
+# Schema version 1 is the model layout at the time versioning was introduced; every
+# entry in SCHEMA_MIGRATIONS upgrades the database by one version.
+SCHEMA_MIGRATIONS = [
+    [
+        "ALTER TABLE product ADD COLUMN revision INTEGER NOT NULL DEFAULT 1",
+        "ALTER TABLE product ADD COLUMN updated_at DATETIME",
+        "UPDATE product SET updated_at = CURRENT_TIMESTAMP",
+    ],
+    [
+        "DELETE FROM cart_item WHERE id NOT IN (SELECT MAX(id) FROM cart_item GROUP BY user_id, product_id)",
+        "CREATE UNIQUE INDEX IF NOT EXISTS ix_cart_item_user_product ON cart_item (user_id, product_id)",
+        'CREATE INDEX IF NOT EXISTS ix_order_user_date ON "order" (user_id, date)',
+        "CREATE INDEX IF NOT EXISTS ix_order_item_order_id ON order_item (order_id)",
+    ],
+    [
+        'ALTER TABLE "order" ADD COLUMN item_count INTEGER NOT NULL DEFAULT 0',
+        'ALTER TABLE "order" ADD COLUMN summary_en TEXT',
+        'ALTER TABLE "order" ADD COLUMN summary_ru TEXT',
+        'UPDATE "order" SET '
+        'item_count = (SELECT COALESCE(SUM(quantity), 0) FROM order_item WHERE order_id = "order".id), '
+        "summary_en = (SELECT group_concat(printf('%s x %d ($%.2f)', product.name_en, order_item.quantity, "
+        "order_item.price), ', ') FROM order_item JOIN product ON product.id = order_item.product_id "
+        'WHERE order_item.order_id = "order".id), '
+        "summary_ru = (SELECT group_concat(printf('%s x %d ($%.2f)', product.name_ru, order_item.quantity, "
+        "order_item.price), ', ') FROM order_item JOIN product ON product.id = order_item.product_id "
+        'WHERE order_item.order_id = "order".id)',
+    ],
+    [
+        "ALTER TABLE product ADD COLUMN sku VARCHAR(64)",
+        "UPDATE product SET sku = CASE WHEN instr(image, '.') > 0 "
+        "THEN substr(image, 1, instr(image, '.') - 1) ELSE image END",
+        "CREATE UNIQUE INDEX IF NOT EXISTS ix_product_sku ON product (sku)",
+    ],
+    [
+        "ALTER TABLE promo_code ADD COLUMN max_uses INTEGER",
+        "ALTER TABLE promo_code ADD COLUMN per_user_limit INTEGER",
+        "ALTER TABLE promo_code ADD COLUMN uses INTEGER NOT NULL DEFAULT 0",
+        "CREATE TABLE IF NOT EXISTS promo_redemption ("
+        "id INTEGER NOT NULL PRIMARY KEY, "
+        "promo_code_id INTEGER NOT NULL REFERENCES promo_code (id), "
+        "user_id INTEGER NOT NULL REFERENCES user (id), "
+        "uses INTEGER NOT NULL, "
+        "UNIQUE (promo_code_id, user_id))",
+        'UPDATE promo_code SET uses = (SELECT COUNT(*) FROM "order" WHERE promo_code_id = promo_code.id)',
+        'INSERT INTO promo_redemption (promo_code_id, user_id, uses) '
+        'SELECT promo_code_id, user_id, COUNT(*) FROM "order" WHERE promo_code_id IS NOT NULL '
+        'GROUP BY promo_code_id, user_id',
+    ],
+    [
+        "CREATE TABLE IF NOT EXISTS product_pair ("
+        "product_id INTEGER NOT NULL REFERENCES product (id), "
+        "other_id INTEGER NOT NULL REFERENCES product (id), "
+        "orders INTEGER NOT NULL, "
+        "PRIMARY KEY (product_id, other_id))",
+        "CREATE INDEX IF NOT EXISTS ix_product_pair_product_orders ON product_pair (product_id, orders, other_id)",
+        "CREATE TABLE IF NOT EXISTS product_neighbor ("
+        "product_id INTEGER NOT NULL REFERENCES product (id), "
+        "neighbor_id INTEGER NOT NULL REFERENCES product (id), "
+        "score INTEGER NOT NULL, "
+        "PRIMARY KEY (product_id, neighbor_id))",
+    ] + RECOMMENDATION_REBUILD_SQL,
+]
+SCHEMA_VERSION = 1 + len(SCHEMA_MIGRATIONS)
+
+def schema_version():
+    return db.session.execute(db.text('PRAGMA user_version')).scalar()
+
+def set_schema_version(version):
+    db.session.execute(db.text('PRAGMA user_version = {:d}'.format(version)))
+    db.session.commit()
+
+def migrate_schema():
+    if schema_version() == SCHEMA_VERSION:
+        return
+    lock = acquire_file_lock('migrate.lock', blocking=True)
+    try:
+        version = schema_version()
+        if version > SCHEMA_VERSION:
+            raise RuntimeError('Database schema version {} is newer than this code ({})'.format(
+                version, SCHEMA_VERSION))
+        if version == 0:
+            # Unversioned databases were rebuilt on every start before, so they are
+            # rebuilt one last time and stamped with the current version.
+            db.drop_all()
+            db.create_all()
+            create_search_index()
+            set_schema_version(SCHEMA_VERSION)
+            return
+        for number in range(version + 1, SCHEMA_VERSION + 1):
+            for statement in SCHEMA_MIGRATIONS[number - 2]:
+                db.session.execute(db.text(statement))
+            set_schema_version(number)
+    finally:
+        lock.close()
+
+def seed_database():
+    products = [
+        Product(name_en="Baggy Jeans", name_ru="Свободные джинсы", price=49.99,
+                description_en="Loose fit denim jeans", description_ru="Джинсы свободного кроя",
+                image="Baggy_Jeans.jpg", stock=random.randint(10, 20)),
+        Product(name_en="Baggy Pants", name_ru="Свободные штаны", price=44.99,
+                description_en="Relaxed casual pants", description_ru="Повседневные штаны свободного кроя",
+                image="Baggy_pants.jpg", stock=random.randint(10, 20)),
+        Product(name_en="Bandana T-shirt", name_ru="Футболка с банданой", price=24.99,
+                description_en="Stylish bandana print tee", description_ru="Футболка с принтом банданы",
+                image="Bandana_T-shirt.jpg", stock=random.randint(10, 20)),
+        Product(name_en="Black T-shirt", name_ru="Черная футболка", price=19.99, description_en="Classic black tee",
+                description_ru="Классическая черная футболка", image="Black_T-shirt.jpg",
+                stock=random.randint(10, 20)),
+        Product(name_en="BLG T-shirt", name_ru="Футболка BLG", price=21.99,
+                description_en="Dark green BLG print tee", description_ru="Темно-зеленая футболка с принтом BLG",
+                image="BLG_T-shirt.jpg", stock=random.randint(10, 20)),
+        Product(name_en="Blue T-shirt", name_ru="Голубая футболка", price=18.99,
+                description_en="Soft blue cotton tee", description_ru="Мягкая голубая хлопковая футболка",
+                image="Blue_T-shirt.jpg", stock=random.randint(10, 20)),
+        Product(name_en="Cargo Pants", name_ru="Штаны карго", price=39.99, description_en="Utility cargo pants",
+                description_ru="Функциональные штаны карго", image="Cargo_pants.jpg", stock=random.randint(10, 20)),
+        Product(name_en="Fashion Boots", name_ru="Модные ботинки", price=59.99,
+                description_en="Trendy fashion boots", description_ru="Модные ботинки", image="Fashion_boots.jpg",
+                stock=random.randint(10, 20)),
+        Product(name_en="Fashion Sneakers", name_ru="Модные кроссовки", price=64.99,
+                description_en="High-top fashion sneakers", description_ru="Модные высокие кроссовки",
+                image="Fashion_sneakers.jpg", stock=random.randint(10, 20)),
+        Product(name_en="Fashion T-shirt", name_ru="Модная футболка", price=22.99,
+                description_en="Branded fashion tee", description_ru="Фирменная модная футболка",
+                image="Fashion_t-shirt.jpg", stock=random.randint(10, 20)),
+        Product(name_en="Fashionable T-shirt", name_ru="Фешенебельная футболка", price=27.99,
+                description_en="Trendy logo tee", description_ru="Модная футболка с логотипом",
+                image="Fashionable_T-shirt.jpg", stock=random.randint(10, 20)),
+        Product(name_en="Glitter T-shirt", name_ru="Блестящая футболка", price=23.99,
+                description_en="T-shirt with glitter print", description_ru="Футболка с блестящим принтом",
+                image="Glitter_t-shirt.jpg", stock=random.randint(10, 20)),
+        Product(name_en="Gray Sweater", name_ru="Серый свитер", price=34.99, description_en="Comfy gray sweater",
+                description_ru="Уютный серый свитер", image="Gray_sweater.jpg", stock=random.randint(10, 20)),
+        Product(name_en="Green T-shirt", name_ru="Зеленая футболка", price=19.99,
+                description_en="Bright green t-shirt", description_ru="Яркая зеленая футболка",
+                image="Green_T-shirt.jpg", stock=random.randint(10, 20)),
+        Product(name_en="Jeans", name_ru="Джинсы", price=44.99, description_en="Classic straight jeans",
+                description_ru="Классические прямые джинсы", image="Jeans1.jpg", stock=random.randint(10, 20)),
+        Product(name_en="Jungle T-shirt", name_ru="Футболка Jungle", price=25.99,
+                description_en="T-shirt with jungle print", description_ru="Футболка с принтом джунглей",
+                image="jungle_t-shirt.jpg", stock=random.randint(10, 20)),
+        Product(name_en="Polo", name_ru="Поло", price=31.99, description_en="Black polo shirt",
+                description_ru="Черная рубашка поло", image="polo.jpg", stock=random.randint(10, 20)),
+        Product(name_en="Red Sneakers", name_ru="Красные кроссовки", price=59.99,
+                description_en="Bright red athletic sneakers", description_ru="Яркие красные кроссовки",
+                image="Red_sneakers.jpg", stock=random.randint(10, 20)),
+        Product(name_en="Running Sneakers", name_ru="Беговые кроссовки", price=64.99,
+                description_en="Lightweight running sneakers", description_ru="Легкие кроссовки для бега",
+                image="Running_sneakers.jpg", stock=random.randint(10, 20)),
+        Product(name_en="Spotted Pants", name_ru="Штаны с пятнами", price=35.99,
+                description_en="Patterned casual pants", description_ru="Повседневные штаны с пятнами",
+                image="Spotted_pants.jpg", stock=random.randint(10, 20)),
+        Product(name_en="Sweater", name_ru="Свитер", price=34.99, description_en="Warm pink sweater",
+                description_ru="Теплый розовый свитер", image="Sweater.jpg", stock=random.randint(10, 20)),
+        Product(name_en="Torn BT-shirt", name_ru="Рваная футболка (BT)", price=24.99,
+                description_en="Black torn t-shirt", description_ru="Черная рваная футболка",
+                image="Torn_bt-shirt.jpg", stock=random.randint(10, 20)),
+        Product(name_en="Torn T-shirt", name_ru="Рваная футболка", price=24.99,
+                description_en="Givenchy style torn tee", description_ru="Футболка в стиле Givenchy",
+                image="Torn_t-shirt.jpg", stock=random.randint(10, 20)),
+        Product(name_en="Trousers", name_ru="Брюки", price=42.99, description_en="Formal black trousers",
+                description_ru="Классические черные брюки", image="trousers.jpg", stock=random.randint(10, 20)),
+        Product(name_en="T-shirt", name_ru="Футболка", price=19.99, description_en="Everyday black tee",
+                description_ru="Повседневная черная футболка", image="T-shirt.jpg", stock=random.randint(10, 20)),
+        Product(name_en="T-shirt with Print", name_ru="Футболка с принтом", price=22.99,
+                description_en="Yellow tee with print", description_ru="Желтая футболка с принтом",
+                image="T-shirt_w_print.jpg", stock=random.randint(10, 20)),
+        Product(name_en="Turquoise T-shirt", name_ru="Бирюзовая футболка", price=20.99,
+                description_en="Two-tone turquoise t-shirt", description_ru="Двухцветная бирюзовая футболка",
+                image="turquoise_t-shirt.jpg", stock=random.randint(10, 20)),
+        Product(name_en="W T-shirt", name_ru="Футболка W", price=21.99, description_en="W logo print t-shirt",
+                description_ru="Футболка с принтом W", image="W_T-shirt.jpg", stock=random.randint(10, 20)),
+        Product(name_en="White Boots", name_ru="Белые ботинки", price=54.99, description_en="Stylish white boots",
+                description_ru="Стильные белые ботинки", image="White_boots.jpg", stock=random.randint(10, 20)),
+    ]
+    for product in products:
+        product.sku = os.path.splitext(product.image)[0]
+    existing_skus = {sku for sku, in db.session.query(Product.sku)}
+    products = [product for product in products if product.sku not in existing_skus]
+    db.session.bulk_save_objects(products)
+    promo_codes = [
+        PromoCode(
+            code="EASTER20",
+            discount_percent=20,
+            valid_until=datetime(2025, 12, 31, tzinfo=timezone.utc)
+        ),
+        PromoCode(
+            code="ROMANOVLEXA25",
+            discount_percent=25,
+            valid_until=datetime(2025, 12, 31, tzinfo=timezone.utc)
+        )
+    ]
+    existing_codes = {code for code, in db.session.query(PromoCode.code)}
+    promo_codes = [promo for promo in promo_codes if promo.code not in existing_codes]
+    db.session.bulk_save_objects(promo_codes)
+    db.session.commit()
+    return len(products), len(promo_codes)
+
+@app.cli.command('migrate')
+def migrate_command():
+    """Upgrade the database schema to the current version."""
+    migrate_schema()
+    click.echo('Schema version {}.'.format(schema_version()))
+
+@app.cli.command('seed')
+def seed_command():
+    """Add the demo catalog and promo codes that are missing from the database."""
+    products, promo_codes = seed_database()
+    promo_index.invalidate()
+    click.echo('Added {} products and {} promo codes.'.format(products, promo_codes))
+
+@app.cli.command('promo-code')
+@click.argument('code')
+@click.option('--discount', type=click.IntRange(1, 100), help='Discount in percent.')
+@click.option('--valid-until', type=click.DateTime(['%Y-%m-%d']), help='Last valid day (UTC).')
+@click.option('--max-uses', type=click.IntRange(0), help='Total redemptions allowed; 0 removes the limit.')
+@click.option('--per-user-limit', type=click.IntRange(0), help='Redemptions allowed per user; 0 removes the limit.')
+@click.option('--active/--inactive', default=None)
+def promo_code_command(code, discount, valid_until, max_uses, per_user_limit, active):
+    """Create or update a promo code and reload it in every worker."""
+    promo = PromoCode.query.filter_by(code=code).first()
+    if promo is None:
+        if discount is None or valid_until is None:
+            raise click.UsageError('New promo codes need --discount and --valid-until.')
+        promo = PromoCode(code=code, uses=0)
+        db.session.add(promo)
+    if discount is not None:
+        promo.discount_percent = discount
+    if valid_until is not None:
+        promo.valid_until = valid_until.replace(hour=23, minute=59, second=59, tzinfo=timezone.utc)
+    if max_uses is not None:
+        promo.max_uses = max_uses or None
+    if per_user_limit is not None:
+        promo.per_user_limit = per_user_limit or None
+    if active is not None:
+        promo.is_active = active
+    db.session.commit()
+    promo_index.invalidate()
+    click.echo('{}: {}% until {:%Y-%m-%d}, {} of {} uses, {} per user{}.'.format(
+        promo.code, promo.discount_percent, promo.valid_until, promo.uses, promo.max_uses or 'unlimited',
+        promo.per_user_limit or 'unlimited', '' if promo.is_active else ', inactive'))
+
+@app.cli.command('rebuild-recommendations')
+def rebuild_recommendations_command():
+    """Recount co-purchases from every order and rebuild the top-K neighbors."""
+    for statement in RECOMMENDATION_REBUILD_SQL:
+        db.session.execute(db.text(statement))
+    db.session.commit()
+    click.echo('{} product pairs, {} neighbors.'.format(
+        db.session.query(ProductPair).count(), db.session.query(ProductNeighbor).count()))
+
+@app.cli.command('build-images')
+@click.option('--jobs', type=click.IntRange(1), help='Worker processes; one per CPU by default.')
+@click.option('--force', is_flag=True, help='Rebuild every image, not just the changed ones.')
+def build_images_command(jobs, force):
+    """Build resized, content-hashed WebP/AVIF variants of static/images."""
+    try:
+        import images
+    except ImportError:
+        raise click.ClickException('Pillow is required to build images.')
+    built, unchanged, formats = images.build_images(
+        os.path.join(app.static_folder, 'images'), app.config['IMAGE_BUILD_DIR'],
+        os.path.join(app.config['IMAGE_BUILD_DIR'], 'manifest.json'), jobs, force)
+    click.echo('Built {} images, {} unchanged ({}).'.format(built, unchanged, ', '.join(formats)))
+
+@app.cli.command('build-assets')
+def build_assets_command():
+    """Build the purged CSS and the JS bundle with hashed names and .gz/.br copies."""
+    import assets
+    try:
+        sizes = assets.build_assets(
+            os.path.join(app.static_folder, 'src'), app.config['ASSET_BUILD_DIR'],
+            os.path.join(app.config['ASSET_BUILD_DIR'], 'manifest.json'), app.config['TAILWINDCSS_BIN'],
+            os.path.join(app.root_path, 'tailwind.config.js'))
+    except (OSError, subprocess.CalledProcessError) as error:
+        raise click.ClickException('Asset build failed: {}'.format(error))
+    for name, variants in sizes.items():
+        click.echo('{}: {}'.format(name, ', '.join('{} ({} bytes)'.format(variant, size)
+                                                   for variant, size in variants.items())))
+
+@app.cli.command('compile-templates')
+def compile_templates_command():
+    """Compile every template into the bytecode cache."""
+    names = app.jinja_env.list_templates()
+    for name in names:
+        app.jinja_env.get_template(name)
+    click.echo('Compiled {} templates.'.format(len(names)))
+
+PRODUCT_EXPORT_FIELDS = ['sku', 'name_en', 'name_ru', 'price', 'description_en', 'description_ru', 'image', 'stock']
+ORDER_EXPORT_FIELDS = ['order_id', 'date', 'user_id', 'promo_code', 'discount_applied', 'order_total',
+                       'product_id', 'sku', 'quantity', 'price']
+PRODUCT_IMPORT_BATCH_SIZE = 1000
+EXPORT_BATCH_SIZE = 1000
+
+def parse_product_row(row):
+    sku = (row.get('sku') or '').strip()
+    if not sku or not row.get('name_en') or not row.get('name_ru'):
+        raise ValueError('sku, name_en and name_ru are required')
+    stock = row.get('stock')
+    return {
+        'sku': sku,
+        'name_en': row['name_en'],
+        'name_ru': row['name_ru'],
+        'price': float(row['price']),
+        'description_en': row.get('description_en') or None,
+        'description_ru': row.get('description_ru') or None,
+        'image': row.get('image') or None,
+        'stock': int(stock) if stock not in (None, '') else None,
+    }
+
+def product_upsert_statement():
+    # Optional columns that are missing from a row keep their current value on update;
+    # the ON CONFLICT update skips Column.onupdate, so revision and updated_at are set here.
+    statement = sqlite_insert(Product).values(
+        sku=db.bindparam('sku'), name_en=db.bindparam('name_en'), name_ru=db.bindparam('name_ru'),
+        price=db.bindparam('price'), description_en=db.bindparam('description_en'),
+        description_ru=db.bindparam('description_ru'), image=db.bindparam('image'),
+        stock=db.func.coalesce(db.bindparam('stock'), 0))
+    return statement.on_conflict_do_update(index_elements=['sku'], set_={
+        'name_en': statement.excluded.name_en,
+        'name_ru': statement.excluded.name_ru,
+        'price': statement.excluded.price,
+        'description_en': db.func.coalesce(statement.excluded.description_en, Product.description_en),
+        'description_ru': db.func.coalesce(statement.excluded.description_ru, Product.description_ru),
+        'image': db.func.coalesce(statement.excluded.image, Product.image),
+        'stock': db.func.coalesce(db.bindparam('stock'), Product.stock),
+        'revision': Product.revision + 1,
+        'updated_at': datetime.now(timezone.utc),
+    })
+
+def read_product_rows(stream, file_format):
+    # NDJSON lines are yielded unparsed, so a broken line is skipped like a bad CSV row.
+    if file_format == 'csv':
+        return enumerate(csv.DictReader(stream), 1)
+    return ((number, line) for number, line in enumerate(stream, 1) if line.strip())
+
+def parse_ndjson_row(line):
+    row = json.loads(line)
+    if not isinstance(row, dict):
+        raise ValueError('expected a JSON object')
+    return row
+
+def import_products(stream, file_format, batch_size=PRODUCT_IMPORT_BATCH_SIZE, progress=None):
+    statement = product_upsert_statement()
+    imported = skipped = 0
+    batch = []
+
+    def flush():
+        db.session.execute(statement, batch)
         db.session.commit()
+        batch.clear()
+        if progress:
+            progress(imported)
+
+    for number, row in read_product_rows(stream, file_format):
+        try:
+            batch.append(parse_product_row(row if file_format == 'csv' else parse_ndjson_row(row)))
+        except (AttributeError, KeyError, TypeError, ValueError) as error:
+            skipped += 1
+            click.echo('Row {}: {}'.format(number, error), err=True)
+            continue
+        imported += 1
+        if len(batch) >= batch_size:
+            flush()
+    if batch:
+        flush()
+    return imported, skipped
+
+def stream_rows(statement, fields, file_format, batch_size=EXPORT_BATCH_SIZE):
+    rows = db.session.execute(statement.execution_options(stream_results=True, yield_per=batch_size))
+    if file_format == 'csv':
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        writer.writerow(fields)
+        for partition in rows.partitions():
+            writer.writerows(partition)
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+        if buffer.tell():
+            yield buffer.getvalue()
+    else:
+        for partition in rows.partitions():
+            yield ''.join(json.dumps(dict(zip(fields, row)), ensure_ascii=False) + '\n' for row in partition)
+
+def export_products(file_format):
+    columns = [getattr(Product, field) for field in PRODUCT_EXPORT_FIELDS]
+    return stream_rows(db.select(*columns).order_by(Product.id), PRODUCT_EXPORT_FIELDS, file_format)
+
+def export_orders(file_format, since=None, until=None):
+    # One row per order line, in order id order so SQLite walks the primary key
+    # and the order_item index instead of sorting.
+    statement = (
+        db.select(Order.id, db.func.strftime('%Y-%m-%dT%H:%M:%SZ', Order.date), Order.user_id, PromoCode.code,
+                  Order.discount_applied, Order.total, OrderItem.product_id, Product.sku, OrderItem.quantity,
+                  OrderItem.price)
+        .select_from(Order)
+        .join(OrderItem, OrderItem.order_id == Order.id)
+        .join(Product, Product.id == OrderItem.product_id)
+        .outerjoin(PromoCode, PromoCode.id == Order.promo_code_id)
+        .order_by(Order.id, OrderItem.id)
+    )
+    if since:
+        statement = statement.where(Order.date >= since)
+    if until:
+        statement = statement.where(Order.date < until)
+    return stream_rows(statement, ORDER_EXPORT_FIELDS, file_format)
+
+def parse_report_date(value):
+    return datetime.strptime(value, '%Y-%m-%d').replace(tzinfo=timezone.utc)
+
+def guess_file_format(filename, file_format):
+    if file_format:
+        return file_format
+    return 'csv' if filename.lower().endswith('.csv') else 'ndjson'
+
+@app.cli.command('import-products')
+@click.argument('source', type=click.File('r', encoding='utf-8'))
+@click.option('--format', 'file_format', type=click.Choice(['csv', 'ndjson']),
+              help='Input format; guessed from the file extension by default.')
+@click.option('--batch-size', default=PRODUCT_IMPORT_BATCH_SIZE, show_default=True)
+def import_products_command(source, file_format, batch_size):
+    """Upsert products by SKU from a CSV or NDJSON file ("-" reads stdin)."""
+    started = time.perf_counter()
+
+    def progress(imported):
+        elapsed = time.perf_counter() - started
+        click.echo('{} rows, {:.0f} rows/s'.format(imported, imported / elapsed if elapsed else 0), err=True)
+
+    imported, skipped = import_products(source, guess_file_format(source.name, file_format), batch_size, progress)
+    elapsed = time.perf_counter() - started
+    click.echo('Imported {} products ({} skipped) in {:.1f}s, {:.0f} rows/s.'.format(
+        imported, skipped, elapsed, imported / elapsed if elapsed else 0))
+
+@app.cli.command('export-products')
+@click.argument('target', type=click.File('w', encoding='utf-8'), default='-')
+@click.option('--format', 'file_format', type=click.Choice(['csv', 'ndjson']),
+              help='Output format; guessed from the file extension by default.')
+def export_products_command(target, file_format):
+    """Write the catalog as CSV or NDJSON (stdout by default)."""
+    for chunk in export_products(guess_file_format(target.name, file_format)):
+        target.write(chunk)
+
+@app.cli.command('export-orders')
+@click.argument('target', type=click.File('w', encoding='utf-8'), default='-')
+@click.option('--format', 'file_format', type=click.Choice(['csv', 'ndjson']),
+              help='Output format; guessed from the file extension by default.')
+@click.option('--since', type=click.DateTime(['%Y-%m-%d']), help='First day to include (UTC).')
+@click.option('--until', type=click.DateTime(['%Y-%m-%d']), help='Day to stop before (UTC).')
+def export_orders_command(target, file_format, since, until):
+    """Write every order line as CSV or NDJSON (stdout by default)."""
+    since = since and since.replace(tzinfo=timezone.utc)
+    until = until and until.replace(tzinfo=timezone.utc)
+    for chunk in export_orders(guess_file_format(target.name, file_format), since, until):
+        target.write(chunk)
+
+@app.cli.command('sales-report')
+@click.option('--since', type=click.DateTime(['%Y-%m-%d']), help='First day to include (UTC).')
+@click.option('--until', type=click.DateTime(['%Y-%m-%d']), help='Day to stop before (UTC).')
+@click.option('--top', default=20, show_default=True, help='Rows per section in the text report.')
+@click.option('--json', 'as_json', is_flag=True, help='Print the full report as JSON.')
+def sales_report_command(since, until, top, as_json):
+    """Revenue per product and day, promo code uplift and sell-through rates."""
+    import analytics
+    report = analytics.sales_report(since and since.replace(tzinfo=timezone.utc),
+                                    until and until.replace(tzinfo=timezone.utc))
+    if as_json:
+        click.echo(json.dumps(report, ensure_ascii=False, indent=2))
+    else:
+        click.echo(analytics.format_report(report, top))
+
+with app.app_context():
+    migrate_schema()
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def count_query(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault('query_started', []).append(time.perf_counter())
+    if has_app_context():
+        g.query_count = g.get('query_count', 0) + 1
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def time_query(conn, cursor, statement, parameters, context, executemany):
+    elapsed = time.perf_counter() - conn.info['query_started'].pop()
+    if has_app_context():
+        g.query_time = g.get('query_time', 0.0) + elapsed
+        sql_log = g.get('sql_log')
+        if sql_log is not None and len(sql_log) < 100:
+            sql_log.append((statement, round(elapsed, 6)))
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+QUERY_COUNT_BUCKETS = (1, 2, 3, 5, 10, 25, 50, 100)
+
+class Metrics:
+    # Per-process counters and histograms. Every worker periodically dumps its totals to
+    # instance/metrics/<pid>.json and /metrics sums all dumps, so the scrape covers all
+    # gunicorn workers whichever one answers it.
+    def __init__(self, directory):
+        self.directory = directory
+        self.counters = {}
+        self.histograms = {}
+        self.buckets = {}
+        self.lock = threading.Lock()
+        self.flushed_at = 0.0
+
+    def inc(self, name, labels=(), value=1):
+        key = (name, tuple(labels))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, labels, value, buckets=LATENCY_BUCKETS):
+        key = (name, tuple(labels))
+        with self.lock:
+            self.buckets[name] = buckets
+            series = self.histograms.get(key)
+            if series is None:
+                series = self.histograms[key] = [0] * (len(buckets) + 2)
+            for index, bound in enumerate(buckets):
+                if value <= bound:
+                    series[index] += 1
+                    break
+            series[-2] += value
+            series[-1] += 1
+
+    def dump(self):
+        with self.lock:
+            return {
+                'counters': [[name, labels, value] for (name, labels), value in self.counters.items()],
+                'histograms': [[name, labels, series] for (name, labels), series in self.histograms.items()],
+                'buckets': self.buckets
+            }
+
+    def flush(self, force=False):
+        now = time.monotonic()
+        if not force and now - self.flushed_at < app.config['METRICS_FLUSH_INTERVAL']:
+            return
+        self.flushed_at = now
+        os.makedirs(self.directory, exist_ok=True)
+        path = os.path.join(self.directory, '{}.json'.format(os.getpid()))
+        with open(path + '.tmp', 'w', encoding='utf-8') as f:
+            json.dump(self.dump(), f)
+        os.replace(path + '.tmp', path)
+
+    def collect(self):
+        counters, histograms, buckets = {}, {}, {}
+        for filename in os.listdir(self.directory):
+            if not filename.endswith('.json'):
+                continue
+            try:
+                with open(os.path.join(self.directory, filename), encoding='utf-8') as f:
+                    data = json.load(f)
+            except (OSError, ValueError):
+                continue
+            buckets.update(data['buckets'])
+            for name, labels, value in data['counters']:
+                key = (name, tuple(map(tuple, labels)))
+                counters[key] = counters.get(key, 0) + value
+            for name, labels, series in data['histograms']:
+                key = (name, tuple(map(tuple, labels)))
+                total = histograms.setdefault(key, [0] * len(series))
+                for index, value in enumerate(series):
+                    total[index] += value
+        return counters, histograms, buckets
+
+    def render(self):
+        counters, histograms, buckets = self.collect()
+        lines = []
+        for name in sorted({name for name, _ in counters}):
+            lines.append('# TYPE {} counter'.format(name))
+            for (series_name, labels), value in sorted(counters.items()):
+                if series_name == name:
+                    lines.append('{}{} {}'.format(name, format_labels(labels), value))
+        for name in sorted({name for name, _ in histograms}):
+            lines.append('# TYPE {} histogram'.format(name))
+            for (series_name, labels), series in sorted(histograms.items()):
+                if series_name != name:
+                    continue
+                cumulative = 0
+                for bound, count in zip(buckets[name], series):
+                    cumulative += count
+                    lines.append('{}_bucket{} {}'.format(name, format_labels(labels + (('le', bound),)), cumulative))
+                lines.append('{}_bucket{} {}'.format(name, format_labels(labels + (('le', '+Inf'),)), series[-1]))
+                lines.append('{}_sum{} {}'.format(name, format_labels(labels), series[-2]))
+                lines.append('{}_count{} {}'.format(name, format_labels(labels), series[-1]))
+        return '\n'.join(lines) + '\n'
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(key, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+                          for key, value in labels) + '}'
+
+metrics = Metrics(os.path.join(app.instance_path, 'metrics'))
+
+def is_admin_request():
+    token = app.config['ADMIN_TOKEN']
+    return bool(token) and hmac.compare_digest(request.headers.get('X-Admin-Token', ''), token)
+
+def admin_required(view):
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        if not is_admin_request():
+            abort(403)
+        return view(*args, **kwargs)
+    return wrapper
+
+class SlowRequestLog:
+    # Min-heap of the slowest requests seen by this worker, bounded to max_entries.
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self.entries = []
+        self.counter = 0
+        self.lock = threading.Lock()
+
+    def add(self, duration, details):
+        with self.lock:
+            if len(self.entries) >= self.max_entries and duration <= self.entries[0][0]:
+                return
+            self.counter += 1
+            entry = (duration, self.counter, details)
+            if len(self.entries) < self.max_entries:
+                heapq.heappush(self.entries, entry)
+            else:
+                heapq.heapreplace(self.entries, entry)
+
+    def slowest(self):
+        with self.lock:
+            return [details for _, _, details in sorted(self.entries, reverse=True)]
+
+slow_requests = SlowRequestLog(app.config['SLOW_REQUEST_LOG_SIZE'])
+
+@app.before_request
+def start_request_timer():
+    g.request_started = time.perf_counter()
+    g.sql_log = []
+    # Profiling is opt-in per request (X-Profile with the admin token) or sampled.
+    if (request.headers.get('X-Profile') and is_admin_request()) or \
+            random.random() < app.config['PROFILE_SAMPLE_RATE']:
+        profiler = cProfile.Profile()
+        try:
+            profiler.enable()
+        except ValueError:
+            return
+        g.profiler = profiler
+
+def save_profile(profiler):
+    profiler.disable()
+    directory = os.path.join(app.instance_path, 'profiles')
+    os.makedirs(directory, exist_ok=True)
+    filename = '{}-{}-{}.prof'.format(request.endpoint or 'unknown',
+                                      datetime.now(timezone.utc).strftime('%Y%m%dT%H%M%S%f'), os.getpid())
+    profiler.dump_stats(os.path.join(directory, filename))
+    return filename
+
+@app.after_request
+def record_request_metrics(response):
+    if 'request_started' not in g:
+        return response
+    endpoint = request.endpoint or 'unknown'
+    duration = time.perf_counter() - g.request_started
+    profile = None
+    if 'profiler' in g:
+        profile = save_profile(g.pop('profiler'))
+        response.headers['X-Profile-File'] = profile
+    slow_requests.add(duration, {
+        'endpoint': endpoint,
+        'method': request.method,
+        'path': request.full_path,
+        'status': response.status_code,
+        'duration': round(duration, 6),
+        'time': datetime.now(timezone.utc).isoformat(),
+        'profile': profile,
+        'sql': g.get('sql_log', [])
+    })
+    metrics.observe('shop_http_request_duration_seconds',
+                    (('endpoint', endpoint), ('method', request.method), ('status', response.status_code)),
+                    duration)
+    metrics.observe('shop_sql_queries_per_request', (('endpoint', endpoint),), g.get('query_count', 0),
+                    QUERY_COUNT_BUCKETS)
+    metrics.inc('shop_sql_queries_total', (('endpoint', endpoint),), g.get('query_count', 0))
+    metrics.inc('shop_sql_duration_seconds_total', (('endpoint', endpoint),), g.get('query_time', 0.0))
+    metrics.flush()
+    return response
+
+@before_render_template.connect_via(app)
+def start_template_timer(sender, template, context, **extra):
+    g.setdefault('template_started', {})[template.name] = time.perf_counter()
+
+@template_rendered.connect_via(app)
+def record_template_metrics(sender, template, context, **extra):
+    started = g.get('template_started', {}).pop(template.name, None)
+    if started is not None:
+        metrics.observe('shop_template_render_duration_seconds', (('template', template.name),),
+                        time.perf_counter() - started)
+
+def send_immutable(directory, filename, **kwargs):
+    # Built files carry a content hash in their name, so they can be cached forever.
+    response = send_from_directory(directory, filename, max_age=app.config['IMMUTABLE_MAX_AGE'], **kwargs)
+    response.cache_control.public = True
+    response.cache_control.immutable = True
+    return response
+
+@app.route('/images/<path:filename>')
+def built_image(filename):
+    return send_immutable(app.config['IMAGE_BUILD_DIR'], filename)
+
+@app.route('/assets/<path:filename>')
+def built_asset(filename):
+    directory = app.config['ASSET_BUILD_DIR']
+    for encoding, suffix in (('br', '.br'), ('gzip', '.gz')):
+        path = safe_join(directory, filename + suffix)
+        if request.accept_encodings[encoding] and path and os.path.isfile(path):
+            response = send_immutable(directory, filename + suffix, mimetype=mimetypes.guess_type(filename)[0])
+            response.content_encoding = encoding
+            break
+    else:
+        response = send_immutable(directory, filename)
+    response.vary.add('Accept-Encoding')
+    return response
+
+@app.route('/metrics')
+def metrics_endpoint():
+    metrics.flush(force=True)
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+@app.route('/debug/slow')
+@admin_required
+def slow_requests_endpoint():
+    return jsonify(pid=os.getpid(), requests=slow_requests.slowest())
+
+@app.route('/debug/profiles/<path:filename>')
+@admin_required
+def profile_download(filename):
+    return send_from_directory(os.path.join(app.instance_path, 'profiles'), filename, as_attachment=True)
+
+def query_budget(limit):
+    # Over-budget routes log a warning; under app.testing or QUERY_BUDGET_ASSERT they fail.
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            start = g.get('query_count', 0)
+            response = view(*args, **kwargs)
+            used = g.get('query_count', 0) - start
+            if used > limit:
+                message = '{} ran {} SQL queries, budget is {}'.format(request.endpoint, used, limit)
+                if app.testing or app.config['QUERY_BUDGET_ASSERT']:
+                    raise AssertionError(message)
+                app.logger.warning(message)
+            return response
+        return wrapper
+    return decorator
+
+class FragmentCache:
+    # LRU cache of rendered HTML fragments keyed by (product_id, ...), with an index
+    # from product id to its keys so a product's fragments can be dropped at once.
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.keys_by_product = {}
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            html = self.entries.get(key)
+            if html is not None:
+                self.entries.move_to_end(key)
+            return html
+
+    def set(self, key, html):
+        with self.lock:
+            self.entries[key] = html
+            self.entries.move_to_end(key)
+            self.keys_by_product.setdefault(key[0], set()).add(key)
+            while len(self.entries) > self.max_entries:
+                evicted, _ = self.entries.popitem(last=False)
+                self._forget(evicted)
+
+    def invalidate(self, product_ids):
+        with self.lock:
+            for product_id in product_ids:
+                for key in self.keys_by_product.pop(product_id, ()):
+                    self.entries.pop(key, None)
+
+    def _forget(self, key):
+        keys = self.keys_by_product.get(key[0])
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                del self.keys_by_product[key[0]]
+
+card_cache = FragmentCache(app.config['CARD_CACHE_SIZE'])
+
+def invalidate_product_cards(product_ids):
+    card_cache.invalidate(product_ids)
+
+def load_build_manifest(directory):
+    # Written by 'flask build-images' and 'flask build-assets'; without them the
+    # templates fall back to the original images and the Tailwind CDN.
+    try:
+        with open(os.path.join(directory, 'manifest.json'), encoding='utf-8') as manifest:
+            return json.load(manifest)
+    except FileNotFoundError:
+        return {}
+
+image_manifest = load_build_manifest(app.config['IMAGE_BUILD_DIR']).get('images', {})
+asset_manifest = load_build_manifest(app.config['ASSET_BUILD_DIR'])
+
+@app.template_global()
+def image_variants(image):
+    return image_manifest.get(image)
+
+@app.template_global()
+def asset_url(name):
+    filename = asset_manifest.get(name)
+    return url_for('built_asset', filename=filename) if filename else None
+
+@app.template_global()
+def product_card(product, lang):
+    # Other workers change products without invalidating this process, so the key
+    # carries the revision and a changed product simply misses the cache.
+    key = (product.id, lang, product.revision)
+    html = card_cache.get(key)
+    if html is None:
+        html = Markup(app.jinja_env.get_template('_product_card.html').render(
+            product=product, t=translations[lang], lang=lang))
+        card_cache.set(key, html)
+    return html
+
+class PromoIndex:
+    # Redeemable promo codes by code, with a heap ordered by valid_until so expired
+    # codes are dropped from the front. Workers reload the index when the mtime of
+    # the shared generation file changes.
+    def __init__(self, generation_path):
+        self.generation_path = generation_path
+        self.generation = None
+        self.codes = {}
+        self.expiry = []
+        self.lock = threading.Lock()
+
+    def current_generation(self):
+        try:
+            return os.stat(self.generation_path).st_mtime_ns
+        except FileNotFoundError:
+            return 0
+
+    def lookup(self, code, now):
+        with self.lock:
+            generation = self.current_generation()
+            if generation != self.generation:
+                self._load(now)
+                self.generation = generation
+            while self.expiry and self.expiry[0][0] < now:
+                _, expired = heapq.heappop(self.expiry)
+                self.codes.pop(expired, None)
+            return self.codes.get(code)
+
+    def invalidate(self):
+        with open(self.generation_path, 'a'):
+            os.utime(self.generation_path)
+
+    def _load(self, now):
+        promos = PromoCode.query.filter(
+            PromoCode.is_active.is_(True), PromoCode.valid_until >= now,
+            db.or_(PromoCode.max_uses.is_(None), PromoCode.uses < PromoCode.max_uses)).all()
+        self.codes = {promo.code: {
+            'id': promo.id,
+            'code': promo.code,
+            'discount_percent': promo.discount_percent,
+            'valid_until': as_utc(promo.valid_until),
+            'max_uses': promo.max_uses,
+            'per_user_limit': promo.per_user_limit
+        } for promo in promos}
+        self.expiry = [(promo['valid_until'], code) for code, promo in self.codes.items()]
+        heapq.heapify(self.expiry)
+
+promo_index = PromoIndex(os.path.join(app.instance_path, 'promo.generation'))
+
+def redeem_promo(promo, user_id):
+    # Both counters are bumped by conditional writes inside the order transaction, so
+    # concurrent checkouts can never push a code past its limits. Returns the new use
+    # count, or None when a limit has been reached.
+    uses = db.session.execute(
+        db.update(PromoCode)
+        .where(PromoCode.id == promo['id'], PromoCode.is_active.is_(True),
+               db.or_(PromoCode.max_uses.is_(None), PromoCode.uses < PromoCode.max_uses))
+        .values(uses=PromoCode.uses + 1)
+        .returning(PromoCode.uses)
+    ).scalar()
+    if uses is None:
+        return None
+    redemption = sqlite_insert(PromoRedemption).values(promo_code_id=promo['id'], user_id=user_id, uses=1)
+    redemption = redemption.on_conflict_do_update(
+        index_elements=['promo_code_id', 'user_id'],
+        set_={'uses': PromoRedemption.uses + 1},
+        where=PromoRedemption.uses < promo['per_user_limit'] if promo['per_user_limit'] is not None else None)
+    if db.session.execute(redemption).rowcount != 1:
+        return None
+    return uses
+
+def build_version():
+    # Changes with every deploy that changes the HTML without touching a product:
+    # templates, the code (translations live here) and the built image/asset manifests.
+    # Returns the ETag part and the newest file time, the floor for Last-Modified.
+    paths = [os.path.abspath(__file__)]
+    for directory in (app.config['IMAGE_BUILD_DIR'], app.config['ASSET_BUILD_DIR']):
+        if os.path.exists(os.path.join(directory, 'manifest.json')):
+            paths.append(os.path.join(directory, 'manifest.json'))
+    for directory, _, filenames in os.walk(os.path.join(app.root_path, app.template_folder)):
+        paths.extend(os.path.join(directory, filename) for filename in filenames)
+    digest = hashlib.sha1()
+    newest = 0
+    for path in sorted(paths):
+        modified = os.stat(path).st_mtime_ns
+        digest.update('{}:{}'.format(os.path.relpath(path, app.root_path), modified).encode('utf-8'))
+        newest = max(newest, modified)
+    return digest.hexdigest(), datetime.fromtimestamp(newest / 1e9, timezone.utc)
+
+BUILD_VERSION, BUILD_TIME = build_version()
+
+def conditional_response(validators, last_modified, render):
+    # Pages depend on the session (language, user, flashed messages), so they are
+    # revalidated on every visit; a match is answered with 304 before any rendering.
+    if session.get('_flashes'):
+        return render()
+    etag = hashlib.sha1(repr((BUILD_VERSION, validators)).encode('utf-8')).hexdigest()
+    if last_modified is not None:
+        last_modified = max(as_utc(last_modified), BUILD_TIME).replace(microsecond=0)
+    if request.if_none_match:
+        not_modified = request.if_none_match.contains(etag)
+    else:
+        not_modified = (last_modified is not None and request.if_modified_since is not None
+                        and last_modified <= request.if_modified_since)
+    response = Response(status=304) if not_modified else make_response(render())
+    response.set_etag(etag)
+    if last_modified is not None:
+        response.last_modified = last_modified
+    response.cache_control.no_cache = True
+    response.vary.add('Cookie')
+    return response
+
+CATALOG_PAGE_SIZE = 24
+CATALOG_SORTS = ['default', 'price_asc', 'price_desc', 'name']
+
+def encode_cursor(values):
+    return base64.urlsafe_b64encode(json.dumps(values).encode('utf-8')).decode('ascii').rstrip('=')
+
+def decode_cursor(cursor):
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)))
+    except (ValueError, TypeError):
+        return None
+    # Cursors come from the query string: only a scalar sort value and an integer id
+    # SQLite can bind are accepted, anything else starts from the first page.
+    if not isinstance(values, list) or len(values) != 2:
+        return None
+    value, last_id = values
+    if type(last_id) is not int or not -2 ** 63 <= last_id < 2 ** 63:
+        return None
+    if type(value) is int:
+        return values if -2 ** 63 <= value < 2 ** 63 else None
+    if type(value) is float:
+        return values if math.isfinite(value) else None
+    return values if isinstance(value, str) else None
+
+def catalog_filters(args):
+    sort = args.get('sort', 'default')
+    return {
+        'min_price': args.get('min_price', type=float),
+        'max_price': args.get('max_price', type=float),
+        'in_stock': args.get('in_stock') == '1',
+        'sort': sort if sort in CATALOG_SORTS else 'default'
+    }
+
+def catalog_page(lang, min_price=None, max_price=None, in_stock=False, sort='default', cursor=None,
+                 limit=CATALOG_PAGE_SIZE):
+    # Keyset pagination: every sort order is backed by an index on the sort column
+    # (SQLite appends the rowid, so (column, id) is covered) and the cursor holds the
+    # last (value, id) pair, so each page is a bounded index range scan.
+    name_column = Product.name_en if lang == 'en' else Product.name_ru
+    description_column = Product.description_en if lang == 'en' else Product.description_ru
+    query = Product.query.options(db.load_only(Product.id, Product.price, Product.image, Product.stock,
+                                               Product.reserved, Product.revision, name_column,
+                                               description_column))
+    if min_price is not None:
+        query = query.filter(Product.price >= min_price)
+    if max_price is not None:
+        query = query.filter(Product.price <= max_price)
+    if in_stock:
+        query = query.filter(Product.stock > Product.reserved)
+
+    if sort == 'name':
+        sort_column, descending = name_column, False
+    elif sort in ('price_asc', 'price_desc'):
+        sort_column, descending = Product.price, sort == 'price_desc'
+    else:
+        sort_column, descending = None, False
+
+    last = decode_cursor(cursor) if cursor else None
+    if sort_column is None:
+        if last:
+            query = query.filter(Product.id > last[1])
+        query = query.order_by(Product.id)
+    elif descending:
+        if last:
+            query = query.filter(db.tuple_(sort_column, Product.id) < tuple(last))
+        query = query.order_by(sort_column.desc(), Product.id.desc())
+    else:
+        if last:
+            query = query.filter(db.tuple_(sort_column, Product.id) > tuple(last))
+        query = query.order_by(sort_column, Product.id)
+
+    products = query.limit(limit + 1).all()
+    next_cursor = None
+    if len(products) > limit:
+        products = products[:limit]
+        tail = products[-1]
+        value = tail.id if sort_column is None else getattr(tail, sort_column.key)
+        next_cursor = encode_cursor([value, tail.id])
+    return products, next_cursor
 
 @app.route('/')
+@query_budget(1)
 def index():
     lang = session.get('lang', 'en')
-    products = Product.query.all()
-    return render_template('index.html', products=products, t=translations[lang], lang=lang)
+    filters = catalog_filters(request.args)
+    products, next_cursor = catalog_page(lang, cursor=request.args.get('cursor'), **filters)
+    # Links carry only the validated filters, never url_for() options such as _external.
+    args = {name: '1' if value is True else value for name, value in filters.items()
+            if value is not None and value is not False and not (name == 'sort' and value == 'default')}
+    next_url = url_for('index', cursor=next_cursor, **args) if next_cursor else None
+    first_url = url_for('index', **args) if 'cursor' in request.args else None
+    validators = (lang, session.get('username'), sorted(request.args.items(multi=True)),
+                  [(product.id, product.revision) for product in products], next_url)
+    # No Last-Modified: a product leaving the page (sold out under in_stock=1) can be
+    # replaced by an older one, so only the ETag over the product set is a safe validator.
+    return conditional_response(validators, None, lambda: render_template(
+        'index.html', products=products, filters=filters, sorts=CATALOG_SORTS,
+        next_url=next_url, first_url=first_url, t=translations[lang], lang=lang))
+
+@app.route('/search')
+@query_budget(1)
+def search():
+    lang = session.get('lang', 'en')
+    query = request.args.get('q', '').strip()
+    if not query:
+        return redirect(url_for('index'))
+    products = search_products(query, lang)
+    return render_template('search.html', products=products, query=query, t=translations[lang], lang=lang)
 
 @app.route('/set_language/<lang>')
 def set_language(lang):
@@ -270,6 +1849,114 @@ def set_language(lang):
         session['lang'] = lang
     return redirect(request.referrer or url_for('index'))
 
+class PasswordHasher:
+    # Hashing runs in a small process pool so a burst of logins can't starve the
+    # request threads. At most queue_depth hashes are pending per worker; beyond that
+    # requests are turned away with 503 instead of queueing.
+    def __init__(self, workers, queue_depth, timeout):
+        self.workers = workers
+        self.timeout = timeout
+        self.slots = threading.BoundedSemaphore(queue_depth)
+        self.executor = None
+        self.pid = None
+        self.lock = threading.Lock()
+
+    def pool(self):
+        with self.lock:
+            # Gunicorn forks after import, so every worker starts its own pool. The pool
+            # processes are not forked from the worker (which runs the scheduler thread
+            # and holds SQLite connections): they start clean and only import passwords.
+            if self.executor is None or self.pid != os.getpid():
+                self.executor = ProcessPoolExecutor(max_workers=self.workers, mp_context=multiprocessing.get_context(
+                    'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'))
+                self.pid = os.getpid()
+            return self.executor
+
+    def run(self, function, *args):
+        if not self.slots.acquire(blocking=False):
+            metrics.inc('shop_password_hash_rejected_total', (('reason', 'busy'),))
+            raise ServiceUnavailable(retry_after=1)
+        try:
+            future = self.pool().submit(function, *args)
+        except BrokenProcessPool:
+            self.slots.release()
+            self.executor = None
+            raise ServiceUnavailable(retry_after=1)
+        # The slot stays taken until the hash is done, even if this request gives up.
+        future.add_done_callback(lambda _: self.slots.release())
+        try:
+            return future.result(timeout=self.timeout)
+        except BrokenProcessPool:
+            self.executor = None
+            raise ServiceUnavailable(retry_after=1)
+        except TimeoutError:
+            metrics.inc('shop_password_hash_rejected_total', (('reason', 'timeout'),))
+            raise ServiceUnavailable(retry_after=1)
+
+password_hasher = PasswordHasher(app.config['PASSWORD_HASH_WORKERS'], app.config['PASSWORD_HASH_QUEUE_DEPTH'],
+                                 app.config['PASSWORD_HASH_TIMEOUT'])
+
+class RateLimitStore(SQLiteFileStore):
+    schema = [
+        'CREATE TABLE IF NOT EXISTS bucket ('
+        'key TEXT PRIMARY KEY, tokens REAL NOT NULL, updated_at REAL NOT NULL, idle_at REAL NOT NULL)',
+        'CREATE INDEX IF NOT EXISTS ix_bucket_idle_at ON bucket (idle_at)',
+    ]
+
+    def take(self, key, burst, rate, now):
+        # Refill and take a token in one statement; no row comes back when the
+        # bucket is empty. idle_at is when the bucket will be full again.
+        row = self.connection().execute(
+            'INSERT INTO bucket (key, tokens, updated_at, idle_at) VALUES (:key, :burst - 1, :now, :now + 1 / :rate) '
+            'ON CONFLICT (key) DO UPDATE SET '
+            'tokens = min(:burst, tokens + (:now - updated_at) * :rate) - 1, updated_at = :now, '
+            'idle_at = :now + (:burst - min(:burst, tokens + (:now - updated_at) * :rate) + 1) / :rate '
+            'WHERE min(:burst, tokens + (:now - updated_at) * :rate) >= 1 '
+            'RETURNING tokens',
+            {'key': key, 'burst': burst, 'rate': rate, 'now': now}).fetchone()
+        if row is not None:
+            return 0
+        tokens, updated_at = self.connection().execute(
+            'SELECT tokens, updated_at FROM bucket WHERE key = ?', (key,)).fetchone()
+        return (1 - min(burst, tokens + (now - updated_at) * rate)) / rate
+
+    def delete_idle(self, now, batch_size):
+        removed = 0
+        while True:
+            count = self.connection().execute(
+                'DELETE FROM bucket WHERE key IN (SELECT key FROM bucket WHERE idle_at <= ? LIMIT ?)',
+                (now, batch_size)).rowcount
+            removed += count
+            if count < batch_size:
+                return removed
+
+rate_limits = RateLimitStore(app.config['RATE_LIMIT_DATABASE'])
+
+def rate_limit_identities():
+    yield 'ip', request.remote_addr or ''
+    user = session.get('user_id') or request.form.get('username', '').strip().lower()
+    if user:
+        yield 'user', str(user)
+
+def rate_limit(scope, methods=('POST',)):
+    # Runs before the view, so a throttled request costs one SQLite statement and no
+    # ORM queries or password hashing.
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            if app.config['RATE_LIMIT_ENABLED'] and request.method in methods:
+                now = time.time()
+                limits = app.config['RATE_LIMITS'][scope]
+                for kind, identity in rate_limit_identities():
+                    burst, period = limits[kind]
+                    wait = rate_limits.take('{}:{}:{}'.format(scope, kind, identity), burst, burst / period, now)
+                    if wait:
+                        metrics.inc('shop_rate_limited_total', (('scope', scope), ('kind', kind)))
+                        raise TooManyRequests(retry_after=max(1, math.ceil(wait)))
+            return view(*args, **kwargs)
+        return wrapper
+    return decorator
+
 @app.route('/register', methods=['GET', 'POST'])
 def register():
     lang = session.get('lang', 'en')
@@ -280,7 +1967,7 @@ def register():
         if User.query.filter_by(username=username).first() or User.query.filter_by(email=email).first():
             flash(translations[lang]['username'] + ' или ' + translations[lang]['email'] + ' уже существует.', 'error')
             return redirect(url_for('register'))
-        hashed_password = generate_password_hash(password)
+        hashed_password = password_hasher.run(passwords.hash_password, password, app.config['PASSWORD_HASH_METHOD'])
         new_user = User(username=username, password=hashed_password, email=email)
         db.session.add(new_user)
         db.session.commit()
@@ -289,13 +1976,21 @@ def register():
     return render_template('register.html', t=translations[lang], lang=lang)
 
 @app.route('/login', methods=['GET', 'POST'])
+@rate_limit('login')
 def login():
     lang = session.get('lang', 'en')
     if request.method == 'POST':
         username = request.form['username']
         password = request.form['password']
         user = User.query.filter_by(username=username).first()
-        if user and check_password_hash(user.password, password):
+        matches, new_hash = False, None
+        if user:
+            matches, new_hash = password_hasher.run(passwords.verify_password, user.password, password,
+                                                    app.config['PASSWORD_HASH_METHOD'])
+        if matches:
+            if new_hash:
+                user.password = new_hash
+                db.session.commit()
             session['user_id'] = user.id
             session['username'] = user.username
             flash('Вход выполнен успешно!', 'success')
@@ -313,65 +2008,97 @@ def logout():
     return redirect(url_for('index'))
 
 @app.route('/product/<int:product_id>')
+@query_budget(1)
 def product_detail(product_id):
     lang = session.get('lang', 'en')
-    product = Product.query.get_or_404(product_id)
-    return render_template('product.html', product=product, t=translations[lang], lang=lang)
+    # The product and its precomputed neighbors come back from one query, product first.
+    neighbor_ids = db.select(ProductNeighbor.neighbor_id).where(ProductNeighbor.product_id == product_id)
+    rows = (db.session.query(Product)
+            .outerjoin(ProductNeighbor, db.and_(ProductNeighbor.product_id == product_id,
+                                                ProductNeighbor.neighbor_id == Product.id))
+            .filter(db.or_(Product.id == product_id, Product.id.in_(neighbor_ids)))
+            .order_by(Product.id != product_id, ProductNeighbor.score.desc(), Product.id.desc())
+            .all())
+    if not rows or rows[0].id != product_id:
+        abort(404)
+    product, neighbors = rows[0], rows[1:]
+    validators = (lang, session.get('username'), [(item.id, item.revision) for item in rows])
+    last_modified = max((as_utc(item.updated_at) for item in rows if item.updated_at), default=None)
+    return conditional_response(validators, last_modified, lambda: render_template(
+        'product.html', product=product, neighbors=neighbors, t=translations[lang], lang=lang))
+
+# Cart rows are written in the same transaction as the stock hold they belong to,
+# so a committed hold always has its cart line and neither outlives the other.
+CartLine = namedtuple('CartLine', ['product', 'product_id', 'quantity'])
+
+def add_cart_item(user_id, product_id, quantity):
+    statement = sqlite_insert(CartItem).values(user_id=user_id, product_id=product_id, quantity=quantity)
+    db.session.execute(statement.on_conflict_do_update(
+        index_elements=['user_id', 'product_id'],
+        set_={'quantity': CartItem.quantity + statement.excluded.quantity}))
+
+def set_cart_quantities(user_id, quantities):
+    # One batched upsert for the lines that stay and one DELETE for those set to 0.
+    kept = [{'user_id': user_id, 'product_id': product_id, 'quantity': quantity}
+            for product_id, quantity in quantities.items() if quantity > 0]
+    removed = [product_id for product_id, quantity in quantities.items() if quantity <= 0]
+    if kept:
+        statement = sqlite_insert(CartItem)
+        db.session.execute(statement.on_conflict_do_update(
+            index_elements=['user_id', 'product_id'],
+            set_={'quantity': statement.excluded.quantity}), kept)
+    if removed:
+        db.session.execute(
+            db.delete(CartItem)
+            .where(CartItem.user_id == user_id, CartItem.product_id.in_(removed))
+            .execution_options(synchronize_session=False))
+
+def cart_lines(user_id, product_ids):
+    # The given products with the user's cart quantity, 0 where they are not in the cart.
+    query = (db.session.query(Product, CartItem.quantity)
+             .outerjoin(CartItem, db.and_(CartItem.user_id == user_id, CartItem.product_id == Product.id))
+             .filter(Product.id.in_(product_ids)))
+    return [CartLine(product, product.id, quantity or 0) for product, quantity in query.order_by(Product.id)]
 
 @app.route('/add_to_cart/<int:product_id>', methods=['POST'])
+@rate_limit('add_to_cart')
 def add_to_cart(product_id):
     lang = session.get('lang', 'en')
     if 'user_id' not in session:
         flash('Пожалуйста, ' + translations[lang]['login'] + ', чтобы добавить товары в ' + translations[lang]['cart'] + '.', 'error')
         return redirect(url_for('login'))
     product = Product.query.get_or_404(product_id)
-    quantity = int(request.form.get('quantity', 1))
-    if product.stock == 0:
+    quantity = max(int(request.form.get('quantity', 1)), 1)
+    if product.available <= 0:
         flash(translations[lang]['out_of_stock'] + '.', 'error')
         return redirect(url_for('product_detail', product_id=product_id))
-    if product.stock < quantity:
-        flash(translations[lang]['insufficient_stock'].format(product.name_en if lang == 'en' else product.name_ru), 'error')
-        return redirect(url_for('product_detail', product_id=product_id))
-    cart_item = CartItem.query.filter_by(user_id=session['user_id'], product_id=product_id).first()
-    new_quantity = quantity + (cart_item.quantity if cart_item else 0)
-    if product.stock < new_quantity:
+    # Stock already held for this user's cart stays theirs, so only the added quantity is reserved.
+    if not hold_stock(session['user_id'], product_id, quantity, datetime.now(timezone.utc)):
+        db.session.rollback()
         flash(translations[lang]['insufficient_stock'].format(product.name_en if lang == 'en' else product.name_ru), 'error')
         return redirect(url_for('product_detail', product_id=product_id))
-    if cart_item:
-        cart_item.quantity = new_quantity
-    else:
-        cart_item = CartItem(user_id=session['user_id'], product_id=product_id, quantity=quantity)
-        db.session.add(cart_item)
+    add_cart_item(session['user_id'], product_id, quantity)
     db.session.commit()
+    invalidate_product_cards([product_id])
     flash(translations[lang]['add_to_cart'] + '!', 'success')
     return redirect(url_for('cart'))
 
 @app.route('/apply_promo', methods=['POST'])
+@rate_limit('apply_promo')
 def apply_promo():
     lang = session.get('lang', 'en')
     if 'user_id' not in session:
         flash('Пожалуйста, ' + translations[lang]['login'] + ', чтобы применить промокод.', 'error')
         return redirect(url_for('login'))
 
-    promo_code = request.form.get('promo_code')
-    promo = PromoCode.query.filter_by(code=promo_code, is_active=True).first()
-
-    current_time = datetime.now(timezone.utc)
+    promo = promo_index.lookup(request.form.get('promo_code'), datetime.now(timezone.utc))
     if promo:
-        valid_until = promo.valid_until
-        if valid_until.tzinfo is None:
-            valid_until = valid_until.replace(tzinfo=timezone.utc)
-
-        if valid_until >= current_time:
-            session['applied_promo'] = {
-                'code': promo.code,
-                'discount_percent': promo.discount_percent,
-                'id': promo.id
-            }
-            flash(translations[lang]['promo_applied'].format(promo.discount_percent), 'success')
-        else:
-            session.pop('applied_promo', None)
-            flash(translations[lang]['invalid_promo'], 'error')
+        session['applied_promo'] = {
+            'code': promo['code'],
+            'discount_percent': promo['discount_percent'],
+            'id': promo['id']
+        }
+        flash(translations[lang]['promo_applied'].format(promo['discount_percent']), 'success')
     else:
         session.pop('applied_promo', None)
         flash(translations[lang]['invalid_promo'], 'error')
@@ -379,12 +2106,14 @@ def apply_promo():
     return redirect(url_for('cart'))
 
 @app.route('/cart')
+@query_budget(1)
 def cart():
     lang = session.get('lang', 'en')
     if 'user_id' not in session:
         flash('Пожалуйста, ' + translations[lang]['login'] + ', чтобы просмотреть ' + translations[lang]['cart'] + '.', 'error')
         return redirect(url_for('login'))
-    cart_items = CartItem.query.filter_by(user_id=session['user_id']).all()
+    cart_items = (CartItem.query.options(db.joinedload(CartItem.product))
+                  .filter_by(user_id=session['user_id']).order_by(CartItem.id).all())
     subtotal = sum(item.product.price * item.quantity for item in cart_items)
     discount = 0
     applied_promo = session.get('applied_promo')
@@ -397,18 +2126,52 @@ def cart():
                            total=total, discount=discount, applied_promo=applied_promo,
                            t=translations[lang], lang=lang)
 
-@app.route('/remove_from_cart/<int:item_id>')
-def remove_from_cart(item_id):
+@app.route('/cart/update', methods=['POST'])
+@rate_limit('cart_update')
+def update_cart():
     lang = session.get('lang', 'en')
     if 'user_id' not in session:
         flash('Пожалуйста, ' + translations[lang]['login'] + ', чтобы изменить ' + translations[lang]['cart'] + '.', 'error')
         return redirect(url_for('login'))
-    cart_item = CartItem.query.get_or_404(item_id)
-    if cart_item.user_id != session['user_id']:
-        flash('Несанкционированное действие.', 'error')
+    quantities = {}
+    for key, value in request.form.items():
+        if key.startswith('quantity-'):
+            try:
+                quantities[int(key[len('quantity-'):])] = max(int(value), 0)
+            except ValueError:
+                abort(400)
+    lines = [line for line in cart_lines(session['user_id'], list(quantities))
+             if line.quantity != quantities[line.product_id]]
+    if not lines:
+        return redirect(url_for('cart'))
+    # Every changed line gives back its hold and claims the new quantity, so the
+    # whole update either fits in the stock or leaves the cart untouched.
+    now = datetime.now(timezone.utc)
+    release_holds(session['user_id'], [line.product_id for line in lines])
+    failed = [line for line in lines if quantities[line.product_id] > 0
+              and not hold_stock(session['user_id'], line.product_id, quantities[line.product_id], now)]
+    if failed:
+        db.session.rollback()
+        flash(translations[lang]['insufficient_stock'].format(', '.join(
+            line.product.name_en if lang == 'en' else line.product.name_ru for line in failed)), 'error')
         return redirect(url_for('cart'))
-    db.session.delete(cart_item)
+    set_cart_quantities(session['user_id'], {line.product_id: quantities[line.product_id] for line in lines})
+    db.session.commit()
+    invalidate_product_cards([line.product_id for line in lines])
+    flash(translations[lang]['cart_updated'], 'success')
+    return redirect(url_for('cart'))
+
+@app.route('/remove_from_cart/<int:product_id>')
+@rate_limit('cart_update', methods=('GET',))
+def remove_from_cart(product_id):
+    lang = session.get('lang', 'en')
+    if 'user_id' not in session:
+        flash('Пожалуйста, ' + translations[lang]['login'] + ', чтобы изменить ' + translations[lang]['cart'] + '.', 'error')
+        return redirect(url_for('login'))
+    release_holds(session['user_id'], [product_id])
+    set_cart_quantities(session['user_id'], {product_id: 0})
     db.session.commit()
+    invalidate_product_cards([product_id])
     flash(translations[lang]['remove'] + ' из ' + translations[lang]['cart'] + '.', 'success')
     return redirect(url_for('cart'))
 
@@ -426,44 +2189,56 @@ def place_order():
         flash(translations[lang]['address_required'], 'error')
         return redirect(url_for('cart'))
 
-    cart_items = CartItem.query.filter_by(user_id=session['user_id']).all()
+    cart_items = CartItem.query.options(db.joinedload(CartItem.product)).filter_by(user_id=session['user_id']).all()
     if not cart_items:
         flash(translations[lang]['empty_cart'] + '.', 'error')
         return redirect(url_for('cart'))
 
-    for item in cart_items:
-        if item.product.stock < item.quantity:
-            flash(translations[lang]['insufficient_stock'].format(
-                item.product.name_en if lang == 'en' else item.product.name_ru), 'error')
-            return redirect(url_for('cart'))
-
     subtotal = sum(item.product.price * item.quantity for item in cart_items)
     discount = 0
     applied_promo = session.get('applied_promo')
-    promo_id = None
+    promo = None
 
     if applied_promo:
-        promo = PromoCode.query.get(applied_promo['id'])
-        if promo:
-            valid_until = promo.valid_until
-            if valid_until.tzinfo is None:
-                valid_until = valid_until.replace(tzinfo=timezone.utc)
-
-            current_time = datetime.now(timezone.utc)
-            if valid_until >= current_time and promo.is_active:
-                discount = subtotal * (applied_promo['discount_percent'] / 100)
-                promo_id = promo.id
+        promo = promo_index.lookup(applied_promo['code'], datetime.now(timezone.utc))
+        if promo and promo['id'] == applied_promo['id']:
+            discount = subtotal * (promo['discount_percent'] / 100)
+        else:
+            promo = None
 
     total = subtotal - discount
 
+    # The stock checks happen inside the UPDATEs, so the write transaction starts here
+    # and every line that lost a race is reported at once.
+    failed = decrement_stock(session['user_id'], [(item.product_id, item.quantity) for item in cart_items],
+                             datetime.now(timezone.utc))
+    if failed:
+        names = [item.product.name_en if lang == 'en' else item.product.name_ru
+                 for item in cart_items if item.product_id in failed]
+        db.session.rollback()
+        flash(translations[lang]['insufficient_stock'].format(', '.join(names)), 'error')
+        return redirect(url_for('cart'))
+    promo_uses = None
+    if promo:
+        promo_uses = redeem_promo(promo, session['user_id'])
+        if promo_uses is None:
+            db.session.rollback()
+            session.pop('applied_promo', None)
+            flash(translations[lang]['promo_limit_reached'], 'error')
+            return redirect(url_for('cart'))
+    sold_out = any(item.product.stock == item.quantity for item in cart_items)
+
     order = Order(
         user_id=session['user_id'],
         total=total,
         delivery_address=delivery_address,
         latitude=float(latitude) if latitude else None,
         longitude=float(longitude) if longitude else None,
-        promo_code_id=promo_id,
-        discount_applied=discount if discount > 0 else None
+        promo_code_id=promo['id'] if promo else None,
+        discount_applied=discount if discount > 0 else None,
+        item_count=sum(item.quantity for item in cart_items),
+        summary_en=order_summary(cart_items, 'en'),
+        summary_ru=order_summary(cart_items, 'ru')
     )
 
     db.session.add(order)
@@ -476,388 +2251,83 @@ def place_order():
             quantity=item.quantity,
             price=item.product.price
         )
-        item.product.stock -= item.quantity
-        if item.product.stock == 0:
-            item.product.restock_time = datetime.now(timezone.utc)
         db.session.add(order_item)
         db.session.delete(item)
 
+    product_ids = [item.product_id for item in cart_items]
+    record_co_purchases(product_ids)
     session.pop('applied_promo', None)
     db.session.commit()
+    invalidate_product_cards(product_ids)
+    if sold_out:
+        restock_wakeup.set()
+    if promo_uses is not None and promo['max_uses'] is not None and promo_uses >= promo['max_uses']:
+        promo_index.invalidate()
     flash('Заказ успешно оформлен!', 'success')
     return redirect(url_for('orders'))
 
+ORDERS_PAGE_SIZE = 10
+
+def order_summary(cart_items, lang):
+    return ', '.join('{} x {} (${:.2f})'.format(
+        item.product.name_en if lang == 'en' else item.product.name_ru, item.quantity, item.product.price)
+        for item in cart_items)
+
+def orders_page(user_id, lang, cursor=None, limit=ORDERS_PAGE_SIZE):
+    # One range scan of the (user_id, date) index; the cursor is the last (date, id).
+    summary_column = Order.summary_en if lang == 'en' else Order.summary_ru
+    query = (Order.query.options(db.load_only(Order.id, Order.date, Order.total, Order.delivery_address,
+                                              Order.discount_applied, Order.item_count, summary_column))
+             .filter(Order.user_id == user_id))
+    last = decode_cursor(cursor) if cursor else None
+    if last and isinstance(last[0], str):
+        try:
+            last_date = datetime.fromisoformat(last[0])
+        except ValueError:
+            last_date = None
+        if last_date is not None:
+            query = query.filter(db.tuple_(Order.date, Order.id) < (last_date, last[1]))
+    orders = query.order_by(Order.date.desc(), Order.id.desc()).limit(limit + 1).all()
+    next_cursor = None
+    if len(orders) > limit:
+        orders = orders[:limit]
+        next_cursor = encode_cursor([orders[-1].date.isoformat(), orders[-1].id])
+    return orders, next_cursor
+
 @app.route('/orders')
+@query_budget(1)
 def orders():
     lang = session.get('lang', 'en')
     if 'user_id' not in session:
         flash('Пожалуйста, ' + translations[lang]['login'] + ', чтобы просмотреть ' + translations[lang]['orders'] + '.', 'error')
         return redirect(url_for('login'))
-    orders = Order.query.filter_by(user_id=session['user_id']).order_by(Order.date.desc()).all()
-    return render_template('orders.html', orders=orders, t=translations[lang], lang=lang)
-
-threading.Thread(target=restock_products, daemon=True).start()
-
-os.makedirs('templates', exist_ok=True)
-templates = {
-    'base.html': '''
-<!DOCTYPE html>
-<html lang="{{ lang }}">
-<head>
-    <meta charset="UTF-8">
-    <meta name="viewport" content="width=device-width, initial-scale=1.0">
-    <title>{{ t.title }}</title>
-    <script src="https://cdn.tailwindcss.com"></script>
-    <script>
-        tailwind.config = {
-            darkMode: 'class'
-        };
-    </script>
-    <script>
-        const savedTheme = localStorage.getItem('theme');
-        if (
-            savedTheme === 'dark' ||
-            (!savedTheme && window.matchMedia('(prefers-color-scheme: dark)').matches)
-        ) {
-            document.documentElement.classList.add('dark');
-        }
-    </script>
-</head>
-<body class="bg-gray-100 dark:bg-gray-800 text-gray-900 dark:text-gray-100 transition-colors duration-300">
-    <nav class="bg-blue-600 dark:bg-blue-800 text-white p-4">
-        <div class="container mx-auto flex justify-between items-center">
-            <a href="{{ url_for('index') }}" class="text-2xl font-bold">{{ t.title }}</a>
-            <div class="flex items-center space-x-4">
-                {% if session.username %}
-                    <span class="mr-4">{{ t.welcome.format(session.username) }}</span>
-                    <a href="{{ url_for('cart') }}" class="mr-4 px-2 py-1 bg-gray-200 dark:bg-gray-700 text-gray-900 dark:text-gray-100 rounded">{{ t.cart }}</a>
-                    <a href="{{ url_for('orders') }}" class="mr-4 px-2 py-1 bg-gray-200 dark:bg-gray-700 text-gray-900 dark:text-gray-100 rounded">{{ t.orders }}</a>
-                    <a href="{{ url_for('logout') }}" class="px-2 py-1 bg-gray-200 dark:bg-gray-700 text-gray-900 dark:text-gray-100 rounded">{{ t.logout }}</a>
-                {% else %}
-                    <a href="{{ url_for('login') }}" class="mr-4 px-2 py-1 bg-gray-200 dark:bg-gray-700 text-gray-900 dark:text-gray-100 rounded">{{ t.login }}</a>
-                    <a href="{{ url_for('register') }}" class="px-2 py-1 bg-gray-200 dark:bg-gray-700 text-gray-900 dark:text-gray-100 rounded">{{ t.register }}</a>
-                {% endif %}
-                <a href="{{ url_for('set_language', lang='ru' if lang == 'en' else 'en') }}"
-                   class="px-2 py-1 bg-gray-200 dark:bg-gray-700 text-gray-900 dark:text-gray-100 rounded">
-                   {{ t.language }}
-                </a>
-                <button id="theme-toggle"
-                        onclick="toggleTheme()"
-                        class="px-2 py-1 bg-gray-200 dark:bg-gray-700 text-gray-900 dark:text-gray-100 rounded">
-                    ☀️
-                </button>
-            </div>
-        </div>
-    </nav>
-    <div class="container mx-auto p-4">
-        {% with messages = get_flashed_messages(with_categories=true) %}
-            {% if messages %}
-                {% for category, message in messages %}
-                    <div class="bg-{{ 'green' if category == 'success' else 'red' }}-100 dark:bg-{{ 'green' if category == 'success' else 'red' }}-900 border-{{ 'green' if category == 'success' else 'red' }}-400 dark:border-{{ 'green' if category == 'success' else 'red' }}-600 text-{{ 'green' if category == 'success' else 'red' }}-700 dark:text-{{ 'green' if category == 'success' else 'red' }}-300 px-4 py-3 rounded mb-4">
-                        {{ message }}
-                    </div>
-                {% endfor %}
-            {% endif %}
-        {% endwith %}
-        {% block content %}{% endblock %}
-    </div>
-    <div class="fixed bottom-4 right-4">
-        <button id="easter-egg-button" class="text-gray-100 dark:text-gray-800 hover:text-blue-600 dark:hover:text-blue-400 transition-colors duration-300">
-            {{ 'Secret' if lang == 'en' else 'Секрет' }}
-        </button>
-    </div>
-    <div id="easter-egg-modal" class="fixed inset-0 bg-black bg-opacity-50 flex items-center justify-center hidden">
-        <div class="bg-white dark:bg-gray-700 p-6 rounded-lg shadow-lg text-center max-w-sm">
-            <h2 class="text-2xl font-bold mb-4">{{ 'You Found the Secret!' if lang == 'en' else 'Вы нашли секрет!' }}</h2>
-            <p class="text-lg mb-4">{{ 'Use code <strong>EASTER20</strong> for a surprise!' if lang == 'en' else 'Используйте код ROMANOVLEXA25 для сюрприза!' }}</p>
-            <div class="flex justify-center mb-4">
-                <img src="{{ url_for('static', filename='images/lexa.jpg') if 'lexa.jpg' else 'https://via.placeholder.com/100' }}" alt="T-shirt" class="w-24 h-24 animate-spin-slow">
-            </div>
-            <button onclick="closeEasterEgg()" class="bg-blue-600 dark:bg-blue-700 text-white px-4 py-2 rounded hover:bg-blue-700 dark:hover:bg-blue-600">
-                {{ 'Close' if lang == 'en' else 'Закрыть' }}
-            </button>
-        </div>
-    </div>
-    <script>
-        function toggleTheme() {
-            const html = document.documentElement;
-            const btn = document.getElementById('theme-toggle');
-            const isDark = !html.classList.contains('dark');
-            html.classList.toggle('dark', isDark);
-            localStorage.setItem('theme', isDark ? 'dark' : 'light');
-            btn.textContent = isDark ? '🌙' : '☀️';
-        }
-        document.addEventListener('DOMContentLoaded', () => {
-            console.log('DOM loaded, initializing Easter Egg');
-            const html = document.documentElement;
-            const btn = document.getElementById('theme-toggle');
-            if (btn) {
-                const isDark = html.classList.contains('dark');
-                btn.textContent = isDark ? '🌙' : '☀️';
-            }
-            const easterButton = document.getElementById('easter-egg-button');
-            if (easterButton) {
-                console.log('Easter Egg button found');
-                easterButton.addEventListener('click', () => {
-                    console.log('Easter Egg button clicked, showing modal');
-                    const modal = document.getElementById('easter-egg-modal');
-                    if (modal) {
-                        modal.classList.remove('hidden');
-                    } else {
-                        console.error('Easter Egg modal not found');
-                    }
-                });
-            } else {
-                console.error('Easter Egg button not found');
-            }
-        });
-        function closeEasterEgg() {
-            const modal = document.getElementById('easter-egg-modal');
-            if (modal) {
-                modal.classList.add('hidden');
-            } else {
-                console.error('Easter Egg modal not found when trying to close');
-            }
-        }
-        const style = document.createElement('style');
-        style.innerHTML = `
-            .animate-spin-slow {
-                animation: spin 3s linear infinite;
-            }
-            @keyframes spin {
-                from {
-                    transform: rotate(0deg);
-                }
-                to {
-                    transform: rotate(360deg);
-                }
-            }
-        `;
-        document.head.appendChild(style);
-    </script>
-</body>
-</html>
-''',
-    'index.html': '''
-{% extends 'base.html' %}
-{% block content %}
-    <h1 class="text-3xl font-bold mb-6">{{ t.our_products }}</h1>
-    <div class="grid grid-cols-1 sm:grid-cols-2 md:grid-cols-4 gap-4">
-        {% for product in products %}
-            <div class="bg-white dark:bg-gray-700 rounded-lg shadow-md p-4">
-                <div class="relative w-full h-64 flex items-center justify-center">
-                    <img src="{{ url_for('static', filename='images/' + product.image) if product.image else 'https://via.placeholder.com/150' }}" alt="{{ product.name_en if lang == 'en' else product.name_ru }}" class="max-h-full max-w-full object-contain rounded">
-                </div>
-                <h2 class="text-xl font-semibold mt-2">{{ product.name_en if lang == 'en' else product.name_ru }}</h2>
-                <p class="text-gray-600 dark:text-gray-300">{{ product.description_en if lang == 'en' else product.description_ru }}</p>
-                <p class="text-lg font-bold mt-2">${{ "%.2f" % product.price }}</p>
-                <p class="text-gray-600 dark:text-gray-300">{{ t.stock.format(product.stock) }}</p>
-                <a href="{{ url_for('product_detail', product_id=product.id) }}" class="mt-4 inline-block bg-blue-600 dark:bg-blue-700 text-white px-4 py-2 rounded hover:bg-blue-700 dark:hover:bg-blue-600">{{ t.view_details }}</a>
-            </div>
-        {% endfor %}
-    </div>
-{% endblock %}
-''',
-    'register.html': '''
-{% extends 'base.html' %}
-{% block content %}
-    <h1 class="text-3xl font-bold mb-6">{{ t.register }}</h1>
-    <form method="POST" class="max-w-md">
-        <div class="mb-4">
-            <label for="username" class="block text-gray-700 dark:text-gray-300">{{ t.username }}</label>
-            <input type="text" name="username" id="username" class="w-full border rounded px-3 py-2 bg-white dark:bg-gray-700 text-gray-900 dark:text-gray-100" required>
-        </div>
-        <div class="mb-4">
-            <label for="email" class="block text-gray-700 dark:text-gray-300">{{ t.email }}</label>
-            <input type="email" name="email" id="email" class="w-full border rounded px-3 py-2 bg-white dark:bg-gray-700 text-gray-900 dark:text-gray-100" required>
-        </div>
-        <div class="mb-4">
-            <label for="password" class="block text-gray-700 dark:text-gray-300">{{ t.password }}</label>
-            <input type="password" name="password" id="password" class="w-full border rounded px-3 py-2 bg-white dark:bg-gray-700 text-gray-900 dark:text-gray-100" required>
-        </div>
-        <button type="submit" class="bg-blue-600 dark:bg-blue-700 text-white px-4 py-2 rounded hover:bg-blue-700 dark:hover:bg-blue-600">{{ t.register }}</button>
-    </form>
-{% endblock %}
-''',
-    'login.html': '''
-{% extends 'base.html' %}
-{% block content %}
-    <h1 class="text-3xl font-bold mb-6">{{ t.login }}</h1>
-    <form method="POST" class="max-w-md">
-        <div class="mb-4">
-            <label for="username" class="block text-gray-700 dark:text-gray-300">{{ t.username }}</label>
-            <input type="text" name="username" id="username" class="w-full border rounded px-3 py-2 bg-white dark:bg-gray-700 text-gray-900 dark:text-gray-100" required>
-        </div>
-        <div class="mb-4">
-            <label for="password" class="block text-gray-700 dark:text-gray-300">{{ t.password }}</label>
-            <input type="password" name="password" id="password" class="w-full border rounded px-3 py-2 bg-white dark:bg-gray-700 text-gray-900 dark:text-gray-100" required>
-        </div>
-        <button type="submit" class="bg-blue-600 dark:bg-blue-700 text-white px-4 py-2 rounded hover:bg-blue-700 dark:hover:bg-blue-600">{{ t.login }}</button>
-    </form>
-{% endblock %}
-''',
-    'product.html': '''
-{% extends 'base.html' %}
-{% block content %}
-    <div class="flex flex-col md:flex-row gap-6">
-        <div class="relative w-full md:w-2/3 h-96 flex items-center justify-center">
-            <img src="{{ url_for('static', filename='images/' + product.image) if product.image and product.image in ['Baggy_Jeans.jpg', 'Baggy_pants.jpg', 'Bandana_T-shirt.jpg', 'Black_T-shirt.jpg', 'BLG_T-shirt.jpg', 'Blue_T-shirt.jpg', 'Cargo_pants.jpg', 'Fashion_boots.jpg', 'Fashion_sneakers.jpg', 'Fashion_t-shirt.jpg', 'Fashionable_T-shirt.jpg', 'Glitter_t-shirt.jpg', 'Gray_sweater.jpg', 'Green_T-shirt.jpg', 'Jeans1.jpg', 'jungle_t-shirt.jpg', 'polo.jpg', 'Red_sneakers.jpg', 'Running_sneakers.jpg', 'Spotted_pants.jpg', 'Sweater.jpg', 'Torn_bt-shirt.jpg', 'Torn_t-shirt.jpg', 'trousers.jpg', 'T-shirt.jpg', 'T-shirt_w_print.jpg', 'turquoise_t-shirt.jpg', 'W_T-shirt.jpg', 'White_boots.jpg'] else 'https://via.placeholder.com/300' }}" alt="{{ product.name_en if lang == 'en' else product.name_ru }}" class="max-h-full max-w-full object-contain rounded">
-        </div>
-        <div>
-            <h1 class="text-3xl font-bold mb-4">{{ product.name_en if lang == 'en' else product.name_ru }}</h1>
-            <p class="text-gray-600 dark:text-gray-300 mb-4">{{ product.description_en if lang == 'en' else product.description_ru }}</p>
-            <p class="text-2xl font-bold mb-4">${{ "%.2f" % product.price }}</p>
-            <p class="text-gray-600 dark:text-gray-300 mb-4">{{ t.stock.format(product.stock) }}</p>
-            {% if product.stock > 0 %}
-                <form method="POST" action="{{ url_for('add_to_cart', product_id=product.id) }}">
-                    <label for="quantity" class="block text-gray-700 dark:text-gray-300 mb-2">{{ t.quantity }}</label>
-                    <input type="number" name="quantity" id="quantity" value="1" min="1" max="{{ product.stock }}" class="w-20 border rounded px-3 py-2 mb-4 bg-white dark:bg-gray-700 text-gray-900 dark:text-gray-100">
-                    <button type="submit" class="bg-blue-600 dark:bg-blue-700 text-white px-4 py-2 rounded hover:bg-blue-700 dark:hover:bg-blue-600">{{ t.add_to_cart }}</button>
-                </form>
-            {% else %}
-                <p class="text-red-600 dark:text-red-400">{{ t.out_of_stock }}</p>
-            {% endif %}
-        </div>
-    </div>
-{% endblock %}
-''',
-    'cart.html': '''
-{% extends 'base.html' %}
-{% block content %}
-    <h1 class="text-3xl font-bold mb-6">{{ t.your_cart }}</h1>
-    {% if cart_items %}
-        <div class="bg-white dark:bg-gray-700 rounded-lg shadow-md p-4">
-            {% for item in cart_items %}
-                <div class="flex items-center justify-between border-b py-4">
-                    <div class="flex items-center">
-                        <img src="{{ url_for('static', filename='images/' + item.product.image) if item.product.image else 'https://via.placeholder.com/100' }}" alt="{{ item.product.name_en if lang == 'en' else item.product.name_ru }}" class="w-24 h-24 object-cover rounded mr-4">
-                        <div>
-                            <h2 class="text-lg font-semibold">{{ item.product.name_en if lang == 'en' else item.product.name_ru }}</h2>
-                            <p class="text-gray-600 dark:text-gray-300">${{ "%.2f" % item.product.price }} x {{ item.quantity }}</p>
-                            <p class="text-gray-600 dark:text-gray-300">{{ t.stock.format(item.product.stock) }}</p>
-                        </div>
-                    </div>
-                    <a href="{{ url_for('remove_from_cart', item_id=item.id) }}" class="text-red-600 dark:text-red-400 hover:underline">{{ t.remove }}</a>
-                </div>
-            {% endfor %}
-            <div class="mt-4">
-                <form method="POST" action="{{ url_for('apply_promo') }}" class="mb-4 flex gap-2">
-                    <input type="text" name="promo_code" placeholder="{{ t.promo_code }}" class="border rounded px-3 py-2 bg-white dark:bg-gray-700 text-gray-900 dark:text-gray-100">
-                    <button type="submit" class="bg-blue-600 dark:bg-blue-700 text-white px-4 py-2 rounded hover:bg-blue-700 dark:hover:bg-blue-600">{{ t.apply_promo }}</button>
-                </form>
-                {% if applied_promo %}
-                    <p class="text-green-600 dark:text-green-400 mb-2">{{ t.promo_applied.format(applied_promo.discount_percent) }}</p>
-                {% endif %}
-                <p class="text-lg font-bold">Итого без скидки: ${{ "%.2f" % subtotal }}</p>
-                {% if discount > 0 %}
-                    <p class="text-lg font-bold text-green-600 dark:text-green-400">{{ t.discount }}: -${{ "%.2f" % discount }}</p>
-                {% endif %}
-                <p class="text-xl font-bold">{{ t.total }}: ${{ "%.2f" % total }}</p>
-                <form method="POST" action="{{ url_for('place_order') }}">
-                    <div class="mb-4">
-                        <label for="delivery_address" class="block text-gray-700 dark:text-gray-300">{{ t.delivery_address }}</label>
-                        <input type="text" name="delivery_address" id="delivery_address" class="w-full border rounded px-3 py-2 bg-white dark:bg-gray-700 text-gray-900 dark:text-gray-100" required>
-                        <input type="hidden" name="latitude" id="latitude">
-                        <input type="hidden" name="longitude" id="longitude">
-                    </div>
-                    <div class="mb-4">
-                        <label class="block text-gray-700 dark:text-gray-300 mb-2">Выберите место доставки</label>
-                        <div id="map" class="w-full h-96 rounded"></div>
-                    </div>
-                    <button type="submit" class="mt-4 bg-blue-600 dark:bg-blue-700 text-white px-4 py-2 rounded hover:bg-blue-700 dark:hover:bg-blue-600">{{ t.place_order }}</button>
-                </form>
-            </div>
-        </div>
-    {% else %}
-        <p>{{ t.empty_cart }}</p>
-    {% endif %}
-    <link rel="stylesheet" href="https://unpkg.com/leaflet@1.9.4/dist/leaflet.css" />
-    <script src="https://unpkg.com/leaflet@1.9.4/dist/leaflet.js"></script>
-    <script>
-        const map = L.map('map').setView([58.538183, 31.288503], 12); // Москва пусть будет в начале
-        L.tileLayer('https://{s}.tile.openstreetmap.org/{z}/{x}/{y}.png', {
-            attribution: '© <a href="https://www.openstreetmap.org/copyright">OpenStreetMap</a> contributors'
-        }).addTo(map);
-
-        const marker = L.marker([58.538183, 31.288503], { draggable: true }).addTo(map);
-
-        marker.on('dragend', function (e) {
-            const latlng = marker.getLatLng();
-            document.getElementById('latitude').value = latlng.lat;
-            document.getElementById('longitude').value = latlng.lng;
-
-            fetch(`https://nominatim.openstreetmap.org/reverse?lat=${latlng.lat}&lon=${latlng.lng}&format=json`)
-                .then(response => response.json())
-                .then(data => {
-                    if (data.display_name) {
-                        document.getElementById('delivery_address').value = data.display_name;
-                    }
-                })
-                .catch(error => console.error('Ошибка', error));
-        });
-
-        const addressInput = document.getElementById('delivery_address');
-        addressInput.addEventListener('input', function () {
-            const query = addressInput.value;
-            if (query.length < 3) return;
-
-            fetch(`https://nominatim.openstreetmap.org/search?q=${encodeURIComponent(query)}&format=json&limit=5`)
-                .then(response => response.json())
-                .then(data => {
-                    if (data.length > 0) {
-                        const firstResult = data[0];
-                        const lat = parseFloat(firstResult.lat);
-                        const lon = parseFloat(firstResult.lon);
-                        map.setView([lat, lon], 12);
-                        marker.setLatLng([lat, lon]);
-                        document.getElementById('latitude').value = lat;
-                        document.getElementById('longitude').value = lon;
-                        document.getElementById('delivery_address').value = firstResult.display_name;
-                    }
-                })
-                .catch(error => console.error('Ошибка поиска адреса:', error));
-        });
-    </script>
-{% endblock %}
-''',
-    'orders.html': '''
-{% extends 'base.html' %}
-{% block content %}
-    <h1 class="text-3xl font-bold mb-6">{{ t.your_orders }}</h1>
-    {% if orders %}
-        <div class="bg-white dark:bg-gray-700 rounded-lg shadow-md p-4">
-            {% for order in orders %}
-                <div class="border-b py-4">
-                    <h2 class="text-xl font-semibold">Заказ #{{ order.id }} - {{ order.date.strftime('%Y-%m-%d %H:%M') }}</h2>
-                    <p class="text-gray-600 dark:text-gray-300">{{ t.total }}: ${{ "%.2f" % order.total }}</p>
-                    <p class="text-gray-600 dark:text-gray-300">{{ t.delivery_address }}: {{ order.delivery_address }}</p>
-                    {% if order.discount_applied %}
-                        <p class="text-green-600 dark:text-green-400">{{ t.discount }}: -${{ "%.2f" % order.discount_applied }}</p>
-                    {% endif %}
-                    <h3 class="text-lg font-semibold mt-2">{{ t.our_products }}</h3>
-                    {% for item in order.items %}
-                        <div class="flex items-center justify-between mt-2">
-                            <div>
-                                <p>{{ item.product.name_en if lang == 'en' else item.product.name_ru }} x {{ item.quantity }}</p>
-                                <p class="text-gray-600 dark:text-gray-300">${{ "%.2f" % item.price }} x {{ item.quantity }}</p>
-                            </div>
-                        </div>
-                    {% endfor %}
-                </div>
-            {% endfor %}
-        </div>
-    {% else %}
-        <p>{{ t.no_orders }}</p>
-    {% endif %}
-{% endblock %}
-'''
-}
+    orders, next_cursor = orders_page(session['user_id'], lang, request.args.get('cursor'))
+    next_url = url_for('orders', cursor=next_cursor) if next_cursor else None
+    first_url = url_for('orders') if 'cursor' in request.args else None
+    return render_template('orders.html', orders=orders, next_url=next_url, first_url=first_url,
+                           t=translations[lang], lang=lang)
+
+@app.route('/export/products.<any(csv, ndjson):file_format>')
+@admin_required
+def export_products_endpoint(file_format):
+    mimetype = 'text/csv' if file_format == 'csv' else 'application/x-ndjson'
+    return Response(stream_with_context(export_products(file_format)), mimetype=mimetype + '; charset=utf-8',
+                    headers={'Content-Disposition': 'attachment; filename=products.' + file_format})
 
-for filename, content in templates.items():
-    with open(os.path.join('templates', filename), 'w', encoding='utf-8') as f:
-        f.write(content)
+@app.route('/export/orders.<any(csv, ndjson):file_format>')
+@admin_required
+def export_orders_endpoint(file_format):
+    try:
+        since = parse_report_date(request.args['since']) if request.args.get('since') else None
+        until = parse_report_date(request.args['until']) if request.args.get('until') else None
+    except ValueError:
+        abort(400)
+    mimetype = 'text/csv' if file_format == 'csv' else 'application/x-ndjson'
+    return Response(stream_with_context(export_orders(file_format, since, until)),
+                    mimetype=mimetype + '; charset=utf-8',
+                    headers={'Content-Disposition': 'attachment; filename=orders.' + file_format})
 
-os.makedirs('static/images', exist_ok=True)
+threading.Thread(target=run_restock_scheduler, daemon=True).start()
 
 if __name__ == '__main__':
     app.run(host='0.0.0.0', port=8000)
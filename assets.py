@@ -0,0 +1,62 @@
+import gzip
+import hashlib
+import json
+import os
+import subprocess
+import tempfile
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# The Tailwind standalone CLI (the tailwindcss command installed by pytailwindcss)
+# purges and minifies the CSS; the config targets the v3 line.
+TAILWIND_VERSION = 'v3.4.17'
+
+
+def build_css(tailwind, config_path, source_path):
+    environment = dict(os.environ)
+    environment.setdefault('TAILWINDCSS_VERSION', TAILWIND_VERSION)
+    with tempfile.TemporaryDirectory() as workdir:
+        output_path = os.path.join(workdir, 'app.css')
+        subprocess.run([tailwind, '--config', config_path, '--input', source_path, '--output', output_path,
+                        '--minify'], check=True, env=environment, cwd=os.path.dirname(config_path))
+        with open(output_path, 'rb') as output:
+            return output.read()
+
+
+def write_asset(output_dir, name, data):
+    # The hashed file and its precompressed copies are written before the manifest
+    # points at them, and never change afterwards.
+    stem, extension = os.path.splitext(name)
+    filename = '{}.{}{}'.format(stem, hashlib.sha1(data).hexdigest()[:12], extension)
+    variants = {filename: data, filename + '.gz': gzip.compress(data, 9, mtime=0)}
+    if brotli is not None:
+        variants[filename + '.br'] = brotli.compress(data, quality=11)
+    for variant, content in variants.items():
+        path = os.path.join(output_dir, variant)
+        if not os.path.exists(path):
+            temporary = '{}.{}.tmp'.format(path, os.getpid())
+            with open(temporary, 'wb') as target:
+                target.write(content)
+            os.replace(temporary, path)
+    return filename, {variant: len(content) for variant, content in variants.items()}
+
+
+def build_assets(source_dir, output_dir, manifest_path, tailwind, config_path):
+    os.makedirs(output_dir, exist_ok=True)
+    with open(os.path.join(source_dir, 'app.js'), 'rb') as script:
+        bundles = {
+            'app.css': build_css(tailwind, config_path, os.path.join(source_dir, 'app.css')),
+            'app.js': script.read(),
+        }
+    manifest = {}
+    sizes = {}
+    for name, data in bundles.items():
+        manifest[name], sizes[name] = write_asset(output_dir, name, data)
+    temporary = manifest_path + '.tmp'
+    with open(temporary, 'w', encoding='utf-8') as target:
+        json.dump(manifest, target, indent=1)
+    os.replace(temporary, manifest_path)
+    return sizes
@@ -0,0 +1,305 @@
+import argparse
+import http.cookiejar
+import json
+import multiprocessing
+import os
+import random
+import re
+import sys
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+from datetime import datetime, timedelta, timezone
+
+# The benchmark works on its own database unless DATABASE_URL is set explicitly.
+os.environ.setdefault('DATABASE_URL', 'sqlite:///benchmark.db')
+# One benchmark client would trip the per-IP and per-user rate limits.
+os.environ.setdefault('RATE_LIMITS', 'off')
+
+ROUTES = ['index', 'product_detail', 'add_to_cart', 'apply_promo', 'place_order', 'orders']
+BENCH_PASSWORD = 'benchmark'
+BENCH_PROMO = 'BENCH10'
+
+
+def load_app():
+    import app as shop
+    return shop
+
+
+def percentile(values, fraction):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(fraction * (len(ordered) - 1))))]
+
+
+def summarize(latencies, queries, elapsed=None):
+    # Without a wall-clock duration (sequential runs) throughput is the route's own service rate.
+    report = {}
+    for route in ROUTES:
+        samples = latencies.get(route, [])
+        if not samples:
+            continue
+        report[route] = {
+            'requests': len(samples),
+            'throughput': round(len(samples) / (elapsed or sum(samples)), 2),
+            'p50_ms': round(percentile(samples, 0.50) * 1000, 3),
+            'p95_ms': round(percentile(samples, 0.95) * 1000, 3),
+            'p99_ms': round(percentile(samples, 0.99) * 1000, 3),
+            'queries_per_request': round(sum(queries.get(route, [])) / len(samples), 2)
+            if queries.get(route) else None
+        }
+    return report
+
+
+def print_report(report):
+    print('{:<16}{:>10}{:>12}{:>10}{:>10}{:>10}{:>10}'.format(
+        'route', 'requests', 'req/s', 'p50 ms', 'p95 ms', 'p99 ms', 'queries'))
+    for route, row in report['routes'].items():
+        print('{:<16}{:>10}{:>12}{:>10}{:>10}{:>10}{:>10}'.format(
+            route, row['requests'], row['throughput'], row['p50_ms'], row['p95_ms'], row['p99_ms'],
+            '-' if row['queries_per_request'] is None else row['queries_per_request']))
+
+
+def compare(report, baseline, tolerance):
+    regressions = []
+    for route, row in report['routes'].items():
+        base = baseline['routes'].get(route)
+        if not base:
+            continue
+        if row['p95_ms'] > base['p95_ms'] * (1 + tolerance):
+            regressions.append('{}: p95 {} ms vs baseline {} ms'.format(route, row['p95_ms'], base['p95_ms']))
+        if row['throughput'] < base['throughput'] * (1 - tolerance):
+            regressions.append('{}: {} req/s vs baseline {} req/s'.format(route, row['throughput'], base['throughput']))
+        if row['queries_per_request'] is not None and base.get('queries_per_request') is not None \
+                and row['queries_per_request'] > base['queries_per_request']:
+            regressions.append('{}: {} queries/request vs baseline {}'.format(
+                route, row['queries_per_request'], base['queries_per_request']))
+    return regressions
+
+
+def finish(report, args):
+    print_report(report)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(report, f, indent=2)
+    if args.baseline:
+        with open(args.baseline, encoding='utf-8') as f:
+            regressions = compare(report, json.load(f), args.tolerance)
+        for line in regressions:
+            print('REGRESSION ' + line)
+        if regressions:
+            sys.exit(1)
+
+
+def seed(args):
+    shop = load_app()
+    import passwords
+    rng = random.Random(args.seed)
+    now = datetime.now(timezone.utc)
+    db = shop.db
+    with shop.app.app_context():
+        if shop.Product.query.first():
+            sys.exit('Database already has products; point DATABASE_URL at an empty database.')
+        started = time.perf_counter()
+        images = sorted(name for name in os.listdir(os.path.join(shop.app.static_folder, 'images'))
+                        if name != 'lexa.jpg')
+        for start in range(0, args.products, args.batch_size):
+            db.session.execute(db.insert(shop.Product), [{
+                'sku': 'BENCH-{}'.format(number), 'name_en': 'Item {}'.format(number), 'name_ru': 'Товар {}'.format(number),
+                'price': round(rng.uniform(5, 200), 2),
+                'description_en': 'Synthetic benchmark product', 'description_ru': 'Синтетический товар',
+                'image': images[number % len(images)], 'stock': 1000000
+            } for number in range(start, min(start + args.batch_size, args.products))])
+            db.session.commit()
+        password = passwords.hash_password(BENCH_PASSWORD, shop.app.config['PASSWORD_HASH_METHOD'])
+        for start in range(0, args.users, args.batch_size):
+            db.session.execute(db.insert(shop.User), [{
+                'username': 'bench{}'.format(number), 'email': 'bench{}@example.com'.format(number),
+                'password': password
+            } for number in range(start, min(start + args.batch_size, args.users))])
+            db.session.commit()
+        db.session.add(shop.PromoCode(code=BENCH_PROMO, discount_percent=10,
+                                      valid_until=now + timedelta(days=3650)))
+        db.session.commit()
+        order_id = 0
+        while order_id < args.orders:
+            orders, items = [], []
+            for order_id in range(order_id + 1, min(order_id + args.batch_size, args.orders) + 1):
+                lines = [(rng.randint(1, args.products), rng.randint(1, 3)) for _ in range(rng.randint(1, 4))]
+                total = 0.0
+                summary_en, summary_ru = [], []
+                for product_id, quantity in lines:
+                    price = round(rng.uniform(5, 200), 2)
+                    total += price * quantity
+                    items.append({'order_id': order_id, 'product_id': product_id, 'quantity': quantity,
+                                  'price': price})
+                    summary_en.append('Item {} x {} (${:.2f})'.format(product_id - 1, quantity, price))
+                    summary_ru.append('Товар {} x {} (${:.2f})'.format(product_id - 1, quantity, price))
+                orders.append({'id': order_id, 'user_id': rng.randint(1, args.users), 'total': round(total, 2),
+                               'date': now - timedelta(minutes=rng.randint(0, 60 * 24 * 365)),
+                               'delivery_address': 'Benchmark street {}'.format(order_id),
+                               'item_count': sum(quantity for _, quantity in lines),
+                               'summary_en': ', '.join(summary_en), 'summary_ru': ', '.join(summary_ru)})
+            db.session.execute(db.insert(shop.Order), orders)
+            db.session.execute(db.insert(shop.OrderItem), items)
+            db.session.commit()
+        # Orders are bulk-inserted past place_order(), so the co-purchase tables that
+        # product_detail reads are rebuilt from them in one pass.
+        for statement in shop.RECOMMENDATION_REBUILD_SQL:
+            db.session.execute(db.text(statement))
+        db.session.commit()
+        print('Seeded {} products, {} users, {} orders in {:.1f}s'.format(
+            args.products, args.users, args.orders, time.perf_counter() - started))
+
+
+def client_benchmark(args):
+    shop = load_app()
+    from sqlalchemy import event
+    from sqlalchemy.engine import Engine
+    counter = {'queries': 0}
+
+    @event.listens_for(Engine, 'before_cursor_execute')
+    def count(*_):
+        counter['queries'] += 1
+
+    with shop.app.app_context():
+        product_count = shop.db.session.query(shop.db.func.max(shop.Product.id)).scalar() or 0
+        user_count = shop.db.session.query(shop.db.func.max(shop.User.id)).scalar() or 0
+    if not product_count or not user_count:
+        sys.exit('Seed the benchmark database first: python benchmark.py seed')
+    rng = random.Random(args.seed)
+    client = shop.app.test_client()
+    client.post('/login', data={'username': 'bench{}'.format(rng.randrange(user_count)),
+                                'password': BENCH_PASSWORD})
+    latencies, queries = {}, {}
+
+    def call(route, method, url, **kwargs):
+        counter['queries'] = 0
+        started = time.perf_counter()
+        response = client.open(url, method=method, **kwargs)
+        latencies.setdefault(route, []).append(time.perf_counter() - started)
+        queries.setdefault(route, []).append(counter['queries'])
+        if response.status_code >= 500:
+            raise RuntimeError('{} {} returned {}'.format(method, url, response.status_code))
+
+    for _ in range(args.iterations):
+        product_id = rng.randint(1, product_count)
+        call('index', 'GET', '/?sort=' + rng.choice(['default', 'price_asc', 'price_desc', 'name']))
+        call('product_detail', 'GET', '/product/{}'.format(product_id))
+        call('add_to_cart', 'POST', '/add_to_cart/{}'.format(product_id), data={'quantity': 1})
+        call('apply_promo', 'POST', '/apply_promo', data={'promo_code': BENCH_PROMO})
+        call('place_order', 'POST', '/place_order', data={'delivery_address': 'Benchmark street'})
+        call('orders', 'GET', '/orders')
+    report = {'mode': 'client', 'iterations': args.iterations,
+              'routes': summarize(latencies, queries)}
+    finish(report, args)
+
+
+def http_worker(job):
+    url, duration, product_count, worker = job
+    rng = random.Random(worker)
+    opener = urllib.request.build_opener(urllib.request.HTTPCookieProcessor(http.cookiejar.CookieJar()))
+    username = 'httpbench{}-{}'.format(os.getpid(), worker)
+    latencies = {}
+
+    def call(route, path, data=None):
+        body = urllib.parse.urlencode(data).encode() if data is not None else None
+        started = time.perf_counter()
+        try:
+            opener.open(url + path, body, timeout=30).read()
+        except urllib.error.HTTPError as error:
+            if error.code >= 500:
+                raise
+        latencies.setdefault(route, []).append(time.perf_counter() - started)
+
+    opener.open(url + '/register', urllib.parse.urlencode({
+        'username': username, 'email': username + '@example.com', 'password': BENCH_PASSWORD}).encode()).read()
+    opener.open(url + '/login', urllib.parse.urlencode({
+        'username': username, 'password': BENCH_PASSWORD}).encode()).read()
+    deadline = time.monotonic() + duration
+    while time.monotonic() < deadline:
+        product_id = rng.randint(1, product_count)
+        call('index', '/')
+        call('product_detail', '/product/{}'.format(product_id))
+        call('add_to_cart', '/add_to_cart/{}'.format(product_id), {'quantity': 1})
+        call('apply_promo', '/apply_promo', {'promo_code': BENCH_PROMO})
+        call('place_order', '/place_order', {'delivery_address': 'Benchmark street'})
+        call('orders', '/orders')
+    return latencies
+
+
+def scrape_queries(url):
+    # Per-endpoint SQL statement and request totals from the app's /metrics endpoint.
+    text = urllib.request.urlopen(url + '/metrics', timeout=30).read().decode('utf-8')
+    statements, requests = {}, {}
+    for endpoint, value in re.findall(r'^shop_sql_queries_total\{endpoint="([^"]+)"\} (\S+)$', text, re.M):
+        statements[endpoint] = float(value)
+    for endpoint, value in re.findall(
+            r'^shop_http_request_duration_seconds_count\{endpoint="([^"]+)",[^}]*\} (\S+)$', text, re.M):
+        requests[endpoint] = requests.get(endpoint, 0) + float(value)
+    return statements, requests
+
+
+def http_benchmark(args):
+    url = args.url.rstrip('/')
+    before = scrape_queries(url)
+    started = time.perf_counter()
+    jobs = [(url, args.duration, args.products, worker) for worker in range(args.processes)]
+    with multiprocessing.Pool(args.processes) as pool:
+        results = pool.map(http_worker, jobs)
+    elapsed = time.perf_counter() - started
+    after = scrape_queries(url)
+    latencies, queries = {}, {}
+    for result in results:
+        for route, samples in result.items():
+            latencies.setdefault(route, []).extend(samples)
+    for route in ROUTES:
+        served = after[1].get(route, 0) - before[1].get(route, 0)
+        if served:
+            queries[route] = [(after[0].get(route, 0) - before[0].get(route, 0)) / served] * \
+                len(latencies.get(route, []))
+    report = {'mode': 'http', 'processes': args.processes, 'duration': args.duration,
+              'routes': summarize(latencies, queries, elapsed)}
+    finish(report, args)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Storefront benchmark suite.')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    seed_parser = commands.add_parser('seed', help='fill an empty database with a synthetic catalog')
+    seed_parser.add_argument('--products', type=int, default=100000)
+    seed_parser.add_argument('--users', type=int, default=10000)
+    seed_parser.add_argument('--orders', type=int, default=1000000)
+    seed_parser.add_argument('--batch-size', type=int, default=10000)
+    seed_parser.add_argument('--seed', type=int, default=42)
+    seed_parser.set_defaults(handler=seed)
+
+    for name, handler, help_text in [
+            ('client', client_benchmark, 'drive the routes in-process through the Flask test client'),
+            ('http', http_benchmark,
+             'drive a running server (e.g. gunicorn started with RATE_LIMITS=off) from several processes')]:
+        command = commands.add_parser(name, help=help_text)
+        command.add_argument('--output', help='write the report as JSON to this file')
+        command.add_argument('--baseline', help='compare against a stored JSON report')
+        command.add_argument('--tolerance', type=float, default=0.2,
+                             help='allowed relative slowdown before a route counts as a regression')
+        command.add_argument('--seed', type=int, default=42)
+        command.set_defaults(handler=handler)
+        if name == 'client':
+            command.add_argument('--iterations', type=int, default=200)
+        else:
+            command.add_argument('--url', default='http://127.0.0.1:8000')
+            command.add_argument('--processes', type=int, default=4)
+            command.add_argument('--duration', type=float, default=30.0)
+            command.add_argument('--products', type=int, default=29,
+                                 help='highest product id to request')
+
+    args = parser.parse_args()
+    args.handler(args)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,98 @@
+import hashlib
+import io
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+from PIL import Image, ImageOps
+
+# Every source image is resized to each width (never upscaled) and encoded in every
+# format Pillow can write here; the templates put them all in one srcset.
+IMAGE_WIDTHS = {'thumb': 192, 'card': 480, 'detail': 1200}
+IMAGE_FORMATS = {
+    'avif': ('AVIF', {'quality': 50}),
+    'webp': ('WEBP', {'quality': 80, 'method': 6}),
+}
+SOURCE_EXTENSIONS = ('.jpg', '.jpeg', '.png')
+
+
+def supported_formats():
+    Image.init()
+    return [name for name, (pil_format, _) in IMAGE_FORMATS.items() if pil_format in Image.SAVE]
+
+
+def file_digest(path):
+    digest = hashlib.sha1()
+    with open(path, 'rb') as source:
+        for chunk in iter(lambda: source.read(1024 * 1024), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def write_once(path, data):
+    # Names are content hashes, so an existing file already has these bytes.
+    if os.path.exists(path):
+        return
+    temporary = '{}.{}.tmp'.format(path, os.getpid())
+    with open(temporary, 'wb') as target:
+        target.write(data)
+    os.replace(temporary, path)
+
+
+def build_variants(source_path, output_dir, formats):
+    stem = os.path.splitext(os.path.basename(source_path))[0]
+    with Image.open(source_path) as original:
+        image = ImageOps.exif_transpose(original)
+        image = image.convert('RGBA' if 'A' in image.getbands() else 'RGB')
+    sources = {name: [] for name in formats}
+    for width in sorted({min(width, image.width) for width in IMAGE_WIDTHS.values()}):
+        resized = image if width == image.width else image.resize(
+            (width, max(1, round(image.height * width / image.width))), Image.LANCZOS)
+        for name in formats:
+            pil_format, options = IMAGE_FORMATS[name]
+            buffer = io.BytesIO()
+            resized.save(buffer, pil_format, **options)
+            data = buffer.getvalue()
+            filename = '{}.{}w.{}.{}'.format(stem, width, hashlib.sha1(data).hexdigest()[:12], name)
+            write_once(os.path.join(output_dir, filename), data)
+            sources[name].append([width, filename])
+    return {'width': image.width, 'height': image.height, 'sources': sources}
+
+
+def load_manifest(manifest_path):
+    try:
+        with open(manifest_path, encoding='utf-8') as manifest:
+            return json.load(manifest)
+    except FileNotFoundError:
+        return {}
+
+
+def build_images(source_dir, output_dir, manifest_path, jobs=None, force=False):
+    os.makedirs(output_dir, exist_ok=True)
+    formats = supported_formats()
+    settings = {'widths': IMAGE_WIDTHS, 'formats': formats}
+    previous = load_manifest(manifest_path)
+    previous_images = previous.get('images', {}) if previous.get('settings') == settings and not force else {}
+    images = {}
+    pending = {}
+    for name in sorted(os.listdir(source_dir)):
+        if not name.lower().endswith(SOURCE_EXTENSIONS):
+            continue
+        digest = file_digest(os.path.join(source_dir, name))
+        entry = previous_images.get(name)
+        if entry and entry['digest'] == digest and all(
+                os.path.exists(os.path.join(output_dir, filename))
+                for files in entry['sources'].values() for _, filename in files):
+            images[name] = entry
+        else:
+            pending[name] = digest
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        futures = {name: executor.submit(build_variants, os.path.join(source_dir, name), output_dir, formats)
+                   for name in pending}
+        for name, future in futures.items():
+            images[name] = dict(future.result(), digest=pending[name])
+    temporary = manifest_path + '.tmp'
+    with open(temporary, 'w', encoding='utf-8') as manifest:
+        json.dump({'settings': settings, 'images': images}, manifest, indent=1)
+    os.replace(temporary, manifest_path)
+    return len(pending), len(images) - len(pending), formats
@@ -0,0 +1,17 @@
+from werkzeug.security import check_password_hash, generate_password_hash
+
+# These run in the password hashing pool, so this module only depends on werkzeug.
+
+
+def hash_password(password, method):
+    return generate_password_hash(password, method)
+
+
+def verify_password(stored, password, method):
+    # Returns whether the password matches and, when the stored hash was made with
+    # another method or cost, a replacement hash computed in the same task.
+    if not check_password_hash(stored, password):
+        return False, None
+    if stored.split('$', 1)[0] != method:
+        return True, generate_password_hash(password, method)
+    return True, None
@@ -1 +1,9 @@
-gunicorn app:app
\ No newline at end of file
+set -e
+# The app runs behind one reverse proxy; see TRUSTED_PROXIES in app.py.
+export TRUSTED_PROXIES="${TRUSTED_PROXIES:-1}"
+flask --app app seed
+flask --app app build-images
+# The Tailwind CLI is downloaded on first use; without it the pages fall back to the CDN build.
+flask --app app build-assets || echo 'Asset build failed, serving the Tailwind CDN build.' >&2
+flask --app app compile-templates
+exec gunicorn app:app
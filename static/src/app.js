@@ -0,0 +1,40 @@
+function toggleTheme() {
+    const html = document.documentElement;
+    const btn = document.getElementById('theme-toggle');
+    const isDark = !html.classList.contains('dark');
+    html.classList.toggle('dark', isDark);
+    localStorage.setItem('theme', isDark ? 'dark' : 'light');
+    btn.textContent = isDark ? '🌙' : '☀️';
+}
+document.addEventListener('DOMContentLoaded', () => {
+    console.log('DOM loaded, initializing Easter Egg');
+    const html = document.documentElement;
+    const btn = document.getElementById('theme-toggle');
+    if (btn) {
+        const isDark = html.classList.contains('dark');
+        btn.textContent = isDark ? '🌙' : '☀️';
+    }
+    const easterButton = document.getElementById('easter-egg-button');
+    if (easterButton) {
+        console.log('Easter Egg button found');
+        easterButton.addEventListener('click', () => {
+            console.log('Easter Egg button clicked, showing modal');
+            const modal = document.getElementById('easter-egg-modal');
+            if (modal) {
+                modal.classList.remove('hidden');
+            } else {
+                console.error('Easter Egg modal not found');
+            }
+        });
+    } else {
+        console.error('Easter Egg button not found');
+    }
+});
+function closeEasterEgg() {
+    const modal = document.getElementById('easter-egg-modal');
+    if (modal) {
+        modal.classList.add('hidden');
+    } else {
+        console.error('Easter Egg modal not found when trying to close');
+    }
+}
@@ -0,0 +1,4 @@
+module.exports = {
+    darkMode: 'class',
+    content: ['./templates/**/*.html', './static/src/**/*.js']
+};
@@ -0,0 +1,69 @@
+import os
+import tempfile
+
+import pytest
+
+# app.py opens its database, sessions and scheduler at import time, so the test
+# environment has to be in place before the first import. Every runtime file (the
+# databases, the restock lock, metrics and the template cache) goes to a temp dir.
+INSTANCE_PATH = tempfile.mkdtemp()
+os.environ['INSTANCE_PATH'] = INSTANCE_PATH
+os.environ['DATABASE_URL'] = 'sqlite:///' + os.path.join(INSTANCE_PATH, 'test.db')
+os.environ['RATE_LIMITS'] = 'off'
+os.environ['PASSWORD_HASH_METHOD'] = 'pbkdf2:sha256:1000'
+
+import app as shop
+
+
+@pytest.fixture(scope='module')
+def client():
+    shop.app.config['TESTING'] = True
+    with shop.app.app_context():
+        shop.seed_database()
+        shop.promo_index.invalidate()
+    client = shop.app.test_client()
+    client.post('/register', data={'username': 'budget', 'password': 'secret', 'email': 'budget@example.com'})
+    client.post('/login', data={'username': 'budget', 'password': 'secret'})
+    client.post('/add_to_cart/1', data={'quantity': 1})
+    client.post('/add_to_cart/2', data={'quantity': 1})
+    client.post('/place_order', data={'delivery_address': 'Test street 1'})
+    client.post('/add_to_cart/3', data={'quantity': 2})
+    return client
+
+
+@pytest.mark.parametrize('path', [
+    '/',
+    '/?sort=price_desc&in_stock=1',
+    '/?sort=name&min_price=10&max_price=60',
+    '/product/1',
+    '/cart',
+    '/orders',
+    '/search?q=shirt',
+])
+def test_route_stays_within_query_budget(client, path):
+    # query_budget() raises under app.testing, which the test client propagates.
+    assert client.get(path).status_code == 200
+
+
+def test_catalog_next_page_stays_within_query_budget(client):
+    with shop.app.test_request_context():
+        _, next_cursor = shop.catalog_page('en', sort='name', limit=5)
+    assert client.get('/?sort=name&cursor=' + next_cursor).status_code == 200
+
+
+@pytest.mark.parametrize('values', [[{}, 1], ['2024-01-01T00:00:00', {}], [5, 1], ['not a date', 1]])
+def test_malformed_orders_cursor_shows_first_page(client, values):
+    response = client.get('/orders?cursor=' + shop.encode_cursor(values))
+    assert response.status_code == 200
+    assert 'Test street 1' in response.get_data(as_text=True)
+
+
+def test_query_budget_fails_over_budget():
+    def view():
+        shop.Product.query.first()
+        shop.Product.query.first()
+        return 'ok'
+
+    with shop.app.test_request_context('/'):
+        with pytest.raises(AssertionError, match='budget is 1'):
+            shop.query_budget(1)(view)()